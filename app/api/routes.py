@@ -1,67 +1,110 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, status, BackgroundTasks
-from typing import List
+from fastapi import APIRouter, Depends, UploadFile, File, Header, HTTPException, status, BackgroundTasks, WebSocket, WebSocketDisconnect
+from typing import List, Optional
 from app.domain.models.detection import DetectionResponse
 from app.domain.models.user import User
-from app.auth.router import get_current_user
+from app.auth.router import get_current_user, require_authenticated_user
+from app.core.config import settings
 from app.services.providers import (
     get_emotion_detection_service,
     get_detection_history_service,
     get_single_detection_service,
     get_delete_detection_service
 )
-from fastapi.responses import StreamingResponse
+from app.services.notification import get_notification, wait_for_notification, on_notification
+from app.core.logging import get_logger
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
+from pydantic import TypeAdapter
 import asyncio
-import json
-import io
-from datetime import datetime
+import orjson
+import msgpack
+import hashlib
+from cachetools import TTLCache
+from tempfile import SpooledTemporaryFile
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
+logger = get_logger("api")
 
-def jsonable_encoder(obj):
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_SPOOL_MAX_SIZE = 1024 * 1024
+DETECTION_STATUS_WS_TIMEOUT = 60
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+# (user_id, image sha256) -> DetectionResponse; send `Cache-Control: no-cache` to bypass.
+# Entries are only added once the detection is stored, so a cached detection_id always exists.
+detection_result_cache: TTLCache = TTLCache(
+    maxsize=settings.DETECTION_RESULT_CACHE_SIZE, ttl=settings.DETECTION_RESULT_CACHE_TTL
+)
+
+HISTORY_ADAPTER = TypeAdapter(List[DetectionResponse])
+EMPTY_HISTORY_BODY = b"[]"
+
+# Pre-encoded body for unexpected failures; the real error is only logged.
+# A fresh Response is built per error since FastAPI attaches per-request
+# background tasks to the returned instance.
+GENERIC_500_BODY = orjson.dumps({"detail": "Internal server error"})
+
+def _generic_500() -> Response:
+    return Response(GENERIC_500_BODY, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, media_type="application/json")
+
+def _cache_when_saved(dedup_key: str, detection_result: DetectionResponse) -> None:
     """
-    Recursively convert obj to something JSON serializable (handle datetime, pydantic models, etc).
+    Cache the result once its background save is reported done; failed saves are never cached.
+    """
+    def cache_if_done(detection_status: str) -> None:
+        if detection_status == "done":
+            detection_result_cache[dedup_key] = detection_result
+    on_notification(detection_result.detection_id, cache_if_done)
+
+def _orjson_default(obj):
+    """
+    Serialize objects orjson does not handle natively (pydantic models).
     """
-    if isinstance(obj, datetime):
-        return obj.isoformat()
     if hasattr(obj, 'model_dump'):
-        return jsonable_encoder(obj.model_dump())
-    if isinstance(obj, dict):
-        return {k: jsonable_encoder(v) for k, v in obj.items()}
-    if isinstance(obj, (list, tuple)):
-        return [jsonable_encoder(v) for v in obj]
-    return obj
+        return obj.model_dump()
+    raise TypeError
 
 @router.post("/detect", response_model=DetectionResponse)
 async def detect_emotion(
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    detect_emotions=Depends(get_emotion_detection_service)
+    detect_emotions=Depends(get_emotion_detection_service),
+    cache_control: Optional[str] = Header(None)
 ):
     """
     Detect emotion from image uploaded by user.
     """
     
     try:
+        # Identical re-uploads (client retries) reuse the previous result
+        content = await file.read()
+        dedup_key = f"{current_user.user_id}:{hashlib.sha256(content).hexdigest()}"
+        if not (cache_control and "no-cache" in cache_control):
+            cached_result = detection_result_cache.get(dedup_key)
+            if cached_result is not None:
+                return cached_result
+
         # Split detection (light) and upload/save DB (heavy) into two steps
-        detection_result, bg_args = await detect_emotions(file, current_user, background=True)
-        # Push task upload/save DB into background
+        detection_result, bg_args = await detect_emotions(
+            content, file.filename, file.content_type, current_user, background=True
+        )
+        # Push task upload/save DB into background; the result is cached once it is stored
         background_tasks.add_task(bg_args["background_func"], *bg_args["args"], **bg_args["kwargs"])
+        _cache_when_saved(dedup_key, detection_result)
         return detection_result
     except HTTPException as e:
-        raise HTTPException(
-            status_code=e.status_code,
-            detail=e.detail
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
-        )
+        if e.status_code < status.HTTP_500_INTERNAL_SERVER_ERROR:
+            raise
+        logger.error(f"Emotion detection failed: {e.detail}")
+        return _generic_500()
+    except Exception:
+        logger.exception("Emotion detection failed")
+        return _generic_500()
 
 @router.get("/history", response_model=List[DetectionResponse])
 async def get_detection_history(
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(require_authenticated_user),
     skip: int = 0,
     limit: int = 10,
     get_detections_by_user=Depends(get_detection_history_service)
@@ -69,72 +112,51 @@ async def get_detection_history(
     """
     Get detection history of user.
     """
-    if current_user.is_guest:
-        raise HTTPException(status_code=401, detail="Authentication required for batch detection.")
-    
-    return await get_detections_by_user(current_user.user_id, skip, limit)
+    results = await get_detections_by_user(current_user.user_id, skip, limit)
+    if not results:
+        return Response(EMPTY_HISTORY_BODY, media_type="application/json")
+    # Items are already DetectionResponse objects: serialize once with pydantic-core
+    return Response(HISTORY_ADAPTER.dump_json(results), media_type="application/json")
 
 @router.get("/history/{detection_id}", response_model=DetectionResponse)
 async def get_detection_detail(
     detection_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(require_authenticated_user),
     get_detection=Depends(get_single_detection_service)
 ):
     """
     Get detail of a detection by ID.
     """
-    if current_user.is_guest:
-        raise HTTPException(status_code=401, detail="Authentication required for batch detection.")
-    
-    detection = await get_detection(detection_id)
+    # Ownership is part of the query: other users' detections are simply not found
+    detection = await get_detection(detection_id, current_user.user_id)
     if not detection:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Detection with ID {detection_id} not found"
         )
-    
-    # Check if the detection belongs to the current user
-    if detection.user_id != current_user.user_id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You don't have permission to access this detection"
-        )
         
     return detection
 
 @router.delete("/history/{detection_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_detection_endpoint(
     detection_id: str,
-    current_user: User = Depends(get_current_user),
-    get_detection=Depends(get_single_detection_service),
+    current_user: User = Depends(require_authenticated_user),
     delete_detection=Depends(get_delete_detection_service)
 ):
     """
     Xóa một detection theo ID.
     """
-    if current_user.is_guest:
-        raise HTTPException(status_code=401, detail="Authentication required for batch detection.")
-    detection = await get_detection(detection_id)
-    if not detection:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to delete detection"
-        )
-    
-    # Check if the detection belongs to the current user
-    if detection.user_id != current_user.user_id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You don't have permission to delete this detection"
-        )
-    
-    success = await delete_detection(detection_id)
+    success = await delete_detection(detection_id, current_user.user_id)
     if not success:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to delete detection"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Detection with ID {detection_id} not found"
         )
     
+    for key, cached_result in list(detection_result_cache.items()):
+        if cached_result.detection_id == detection_id:
+            detection_result_cache.pop(key, None)
+    
     return None
 
 @router.get("/detect/status/{detection_id}")
@@ -142,54 +164,101 @@ def get_detection_status(detection_id: str):
     """
     Kiểm tra trạng thái xử lý detection (pending/done/failed).
     """
-    from app.services.notification import get_notification
-    status = get_notification(detection_id)
-    return {"detection_id": detection_id, "status": status}
+    detection_status = get_notification(detection_id)
+    return {"detection_id": detection_id, "status": detection_status}
+
+@router.websocket("/ws/detect/{detection_id}")
+async def detection_status_ws(websocket: WebSocket, detection_id: str):
+    """
+    Push the detection status once processing finishes (alternative to polling /detect/status).
+    """
+    await websocket.accept()
+    try:
+        detection_status = await wait_for_notification(detection_id, timeout=DETECTION_STATUS_WS_TIMEOUT)
+        await websocket.send_json({"detection_id": detection_id, "status": detection_status})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
 
 @router.post("/detect/batch")
 async def detect_emotion_batch(
     background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(...),
-    current_user: User = Depends(get_current_user),
+    accept: Optional[str] = Header(None),
+    current_user: User = Depends(require_authenticated_user),
     detect_emotions=Depends(get_emotion_detection_service),
 ):
     """
     Nhận nhiều file ảnh, trả về kết quả từng phần (streaming, SSE-style).
+    Gửi `Accept: application/x-msgpack` để nhận các frame msgpack có tiền tố độ dài
+    (4 byte big-endian) thay cho SSE.
     Chỉ cho phép người dùng đã đăng nhập (không cho guest).
     """
-    if current_user.is_guest:
-        raise HTTPException(status_code=401, detail="Authentication required for batch detection.")
+    use_msgpack = accept is not None and MSGPACK_MEDIA_TYPE in accept
+
+    def encode_event(obj) -> bytes:
+        if use_msgpack:
+            if hasattr(obj, 'model_dump'):
+                obj = obj.model_dump(mode="json")
+            packed = msgpack.packb(obj)
+            return len(packed).to_bytes(4, "big") + packed
+        return b"data: " + orjson.dumps(obj, default=_orjson_default) + b"\n\n"
 
-    file_contents = []
+    # Files are closed once this handler returns, so stage them first in
+    # bounded-memory spools (anything above 1 MB goes to disk).
+    # Oversized files abort the whole batch before any detection is queued.
+    staged_files = []
     for file in files:
-        content = await file.read()
-        file_contents.append({
-            "filename": file.filename,
-            "content_type": file.content_type,
-            "content": content
-        })
+        spool = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+        staged_files.append((file.filename, file.content_type, spool))
+        size = 0
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > settings.MAX_IMAGE_BYTES:
+                for _, _, staged_spool in staged_files:
+                    staged_spool.close()
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"File '{file.filename}' exceeds maximum allowed size ({settings.MAX_IMAGE_BYTES / 1024:.1f} KB)"
+                )
+            spool.write(chunk)
+        spool.seek(0)
 
     async def event_stream():
-        for file_data in file_contents:
-            try:
-                file_like = io.BytesIO(file_data["content"])
-                upload_file = UploadFile(
-                    file=file_like,
-                    filename=file_data["filename"],
-                )
-                detection_result, bg_args = await detect_emotions(
-                    image=upload_file,
-                    user=current_user,
-                    background=True,
-                    is_BytesIO=True
-                )
-                background_tasks.add_task(bg_args["background_func"], *bg_args["args"], **bg_args["kwargs"])
+        semaphore = asyncio.Semaphore(settings.BATCH_DETECT_CONCURRENCY)
+
+        async def detect_one(filename, content_type, spool) -> bytes:
+            async with semaphore:
+                try:
+                    # Spools above 1 MB live on disk; read them off the event loop
+                    content = await run_in_threadpool(spool.read)
+                    detection_result, bg_args = await detect_emotions(
+                        content, filename, content_type, current_user, background=True
+                    )
+                    background_tasks.add_task(bg_args["background_func"], *bg_args["args"], **bg_args["kwargs"])
+                    return encode_event(detection_result)
+                except HTTPException as e:
+                    if e.status_code < status.HTTP_500_INTERNAL_SERVER_ERROR:
+                        return encode_event({"error": e.detail, "filename": filename})
+                    logger.error(f"Batch emotion detection failed: {e.detail}")
+                    return encode_event({"error": "Internal server error", "filename": filename})
+                except Exception:
+                    logger.exception("Batch emotion detection failed")
+                    return encode_event({"error": "Internal server error", "filename": filename})
 
-                yield f"data: {json.dumps(jsonable_encoder(detection_result))}\n\n"
-                await asyncio.sleep(0)
-            except Exception as e:
-                error = {"error": str(e), "filename": file_data["filename"]}
-                yield f"data: {json.dumps(error)}\n\n"
-                await asyncio.sleep(0)
+        # Results are streamed in completion order, not upload order
+        tasks = [asyncio.create_task(detect_one(*staged)) for staged in staged_files]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Tasks still waiting on the semaphore never read their spool, so the spools are
+            # closed here, after every task is cancelled; a read already running in the
+            # threadpool just fails and its result is discarded.
+            for _, _, spool in staged_files:
+                spool.close()
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    media_type = MSGPACK_MEDIA_TYPE if use_msgpack else "text/event-stream"
+    return StreamingResponse(event_stream(), media_type=media_type)
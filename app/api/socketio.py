@@ -2,26 +2,89 @@
 Socket.IO handler for realtime emotion detection.
 """
 import socketio
+import asyncio
+import functools
+import concurrent.futures
+import os
 import time
-import numpy as np
-from typing import Dict, Any,List
+import traceback
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable, Union
+from dataclasses import dataclass, field
 import logging
+import orjson
 
 from app.core.config import settings
 from app.auth.auth_utils import verify_token
-from app.services.video_emotion_detection import VideoEmotionDetector
+from app.services.video_emotion_detection import VideoEmotionDetector, decode_frame
 from app.core.metrics import realtime_connections_gauge
 
 logger = logging.getLogger(__name__)
 
+DATA_URI_HEADER_MAX_LENGTH = 64
+IMAGE_MAGIC_NUMBERS = (b'\xff\xd8', b'\x89PNG')  # JPEG SOI, PNG signature
+
+# Raw image bytes (binary frame) or base64 text (legacy frame)
+FramePayload = Union[bytes, bytearray, str]
+
+# Static parts of frequent status/error payloads; only the timestamp is added per emit
+STATUS_PROCESSING_STARTED = {'code': 200, 'message': 'Processing started'}
+STATUS_PROCESSING_STOPPED = {'code': 200, 'message': 'Processing stopped'}
+STATUS_CONFIG_UPDATED = {'code': 200, 'message': 'Configuration updated'}
+ERROR_PROCESSING_NOT_STARTED = {'code': 400, 'message': 'Processing not started'}
+ERROR_ROOM_REQUIRED = {'code': 400, 'message': 'Room name is required'}
+
+# base64 + JPEG decode runs here so one client's frame does not stall every other socket
+frame_decode_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=min(20, (os.cpu_count() or 1) * 2),
+    thread_name_prefix="frame-decode"
+)
+
+class OrjsonPacketJson:
+    """json-module stand-in so python-socketio encodes packets with orjson (numpy values included)."""
+    @staticmethod
+    def dumps(obj, *args, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
+# With REDIS_URL set, emits and room membership go through Redis pub/sub so any
+# worker can reach any client; otherwise everything stays in this process.
+client_manager = socketio.AsyncRedisManager(settings.REDIS_URL) if settings.REDIS_URL else None
+
 # Khởi tạo Socket.IO server
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=client_manager,
+    serializer=settings.SOCKETIO_SERIALIZER,
+    json=OrjsonPacketJson,
+    http_compression=True,
+    compression_threshold=settings.SOCKETIO_COMPRESSION_THRESHOLD,
     cors_allowed_origins='*',
     logger=settings.DEBUG,
     engineio_logger=False,
 )
 
+@dataclass(slots=True)
+class ClientState:
+    """Per-connection state, kept here instead of the Socket.IO session so no handler needs get/save_session."""
+    user_id: str
+    connected_at: float
+    client_id: Optional[str] = None
+    config: Dict[str, Any] = field(default_factory=dict)
+    detector: Optional[VideoEmotionDetector] = None
+    is_processing: bool = False  # client sent 'start'
+    # Single-slot buffer of (frame_id, timestamp, payload): video_frame overwrites it,
+    # the consumer task takes the newest frame
+    latest_frame: Optional[Tuple[Any, Optional[float], FramePayload]] = None
+    frame_ready: asyncio.Event = field(default_factory=asyncio.Event)
+    consumer: Optional[asyncio.Task] = None
+    metrics_task: Optional[asyncio.Task] = None
+    eio_sid: Optional[str] = None
+    emit: Optional[Callable[..., Awaitable[None]]] = None  # sio.emit pre-bound to this sid and namespace
+    dropping_results: bool = False  # detection results are being skipped for a slow client
+
 class SocketManager:
     """Manager for Socket.IO connections and event handling."""
     
@@ -33,29 +96,42 @@ class SocketManager:
         
         self.namespace = '/emotion-detection'
         
-        self.detectors: Dict[str, VideoEmotionDetector] = {}
-        
-        self.connection_count = 0
+        self.clients: Dict[str, ClientState] = {}
         
         self.MAX_CONCURRENT_CONNECTIONS = 20
         
-        self.processing_frames: Dict[str, bool] = {}
+        # One slot per accepted connection; taken before authentication, so
+        # concurrent connects cannot both pass the capacity check
+        self._connection_slots = asyncio.BoundedSemaphore(self.MAX_CONCURRENT_CONNECTIONS)
         
-        self.latest_frames: Dict[str, Dict[str, Any]] = {}
+        # Detection results are volatile: once more than BACKPRESSURE_ENTER packets are queued
+        # for a client, skip them until the queue drains to BACKPRESSURE_EXIT
+        self.BACKPRESSURE_ENTER = settings.REALTIME_BACKPRESSURE_ENTER
+        self.BACKPRESSURE_EXIT = settings.REALTIME_BACKPRESSURE_EXIT
+        
+        # Seconds between processing-metrics updates sent to each client
+        self.METRICS_INTERVAL = 3
         
         self._register_handlers()
     
+    @property
+    def connection_count(self) -> int:
+        return len(self.clients)
+    
     def _register_handlers(self):
         """Register all Socket.IO event handlers."""
         @sio.event(namespace=self.namespace)
         async def connect(sid, environ, auth):
             """Handle new connection with authentication."""
-            if self.connection_count >= self.MAX_CONCURRENT_CONNECTIONS:
+            if self._connection_slots.locked():
                 logger.warning(f"Connection limit reached ({self.connection_count}/{self.MAX_CONCURRENT_CONNECTIONS})")
                 raise ConnectionRefusedError('Server is at capacity, please try again later')
+            # A slot is free, so this does not wait
+            await self._connection_slots.acquire()
                 
             if not auth or 'token' not in auth:
                 logger.warning(f"Authentication required for {sid}")
+                self._connection_slots.release()
                 raise ConnectionRefusedError('Authentication required')
 
             try:
@@ -66,14 +142,15 @@ class SocketManager:
                     logger.warning(f"Invalid token for {sid}")
                     raise ConnectionRefusedError('Invalid authentication token')
 
-                await sio.save_session(sid, {
-                    'user_id': user_id,
-                    'connected_at': time.time(),
-                    'is_processing': False,
-                    'config': {}
-                }, namespace=self.namespace)
-                
-                self.connection_count += 1
+                st = ClientState(
+                    user_id=user_id,
+                    connected_at=time.time(),
+                    eio_sid=sio.manager.eio_sid_from_sid(sid, self.namespace),
+                    emit=functools.partial(sio.emit, room=sid, namespace=self.namespace)
+                )
+                st.consumer = asyncio.create_task(self._consumer_loop(sid, st))
+                st.metrics_task = asyncio.create_task(self._metrics_loop(sid, st))
+                self.clients[sid] = st
                 realtime_connections_gauge.set(self.connection_count)
                 
                 logger.info(f"Client connected: {sid} (user: {user_id})")
@@ -81,21 +158,23 @@ class SocketManager:
                 
             except Exception as e:
                 logger.error(f"Authentication error: {str(e)}")
+                self._connection_slots.release()
                 raise ConnectionRefusedError('Authentication failed')
         
         @sio.event(namespace=self.namespace)
         async def disconnect(sid):
             """Handle client disconnection."""
             try:
-                session = await sio.get_session(sid, namespace=self.namespace)
-                user_id = session.get('user_id', 'unknown')
+                st = self.clients.pop(sid, None)
+                user_id = st.user_id if st else 'unknown'
+                if st:
+                    for task in (st.consumer, st.metrics_task):
+                        if task:
+                            task.cancel()
+                    self._connection_slots.release()
                 
-                self.connection_count -= 1
                 realtime_connections_gauge.set(self.connection_count)
                 
-                if sid in self.detectors:
-                    del self.detectors[sid]
-                
                 logger.info(f"Client disconnected: {sid} (user: {user_id})")
                 
             except Exception as e:
@@ -104,18 +183,19 @@ class SocketManager:
         @sio.event(namespace=self.namespace)
         async def initialize(sid, data):
             """Initialize session with configuration."""
+            st = self.clients.get(sid)
+            if st is None:
+                return
             try:
-                session = await sio.get_session(sid, namespace=self.namespace)
                 client_id = data.get('client_id', sid)
                 config = data.get('config', {})
                 
-                session['client_id'] = client_id
-                session['config'] = config
-                await sio.save_session(sid, session, namespace=self.namespace)
+                st.client_id = client_id
+                st.config = config
                 
-                self.detectors[sid] = VideoEmotionDetector(config=config)
+                st.detector = VideoEmotionDetector(config=config)
                 
-                await sio.emit('initialized', {
+                await st.emit('initialized', {
                     'session_id': sid,
                     'timestamp': time.time(),
                     'config': {
@@ -123,146 +203,108 @@ class SocketManager:
                         'max_resolution': [640, 480],
                         'supported_actions': ['start', 'stop', 'configure']
                     }
-                }, room=sid, namespace=self.namespace)
+                })
                 
                 logger.info(f"Client initialized: {sid} (client_id: {client_id})")
                 
             except Exception as e:
                 logger.error(f"Initialization error: {str(e)}")
-                await sio.emit('error_message', {
+                await st.emit('error_message', {
                     'code': 500,
                     'message': f'Failed to initialize: {str(e)}',
                     'timestamp': time.time()
-                }, room=sid, namespace=self.namespace)
+                })
         
         @sio.event(namespace=self.namespace)
         async def control(sid, data):
             """Handle control commands: start, stop, configure."""
+            st = self.clients.get(sid)
+            if st is None:
+                return
             try:
-                session = await sio.get_session(sid, namespace=self.namespace)
                 action = data.get('action')
                 
                 if action == 'start':
-                    session['is_processing'] = True
-                    await sio.save_session(sid, session, namespace=self.namespace)
+                    st.is_processing = True
                     
-                    await sio.emit('status', {
-                        'code': 200,
-                        'message': 'Processing started',
-                        'timestamp': time.time()
-                    }, room=sid, namespace=self.namespace)
+                    await st.emit('status', STATUS_PROCESSING_STARTED | {'timestamp': time.time()})
                     
                 elif action == 'stop':
-                    session['is_processing'] = False
-                    await sio.save_session(sid, session, namespace=self.namespace)
+                    st.is_processing = False
                     
-                    await sio.emit('status', {
-                        'code': 200,
-                        'message': 'Processing stopped',
-                        'timestamp': time.time()
-                    }, room=sid, namespace=self.namespace)
+                    await st.emit('status', STATUS_PROCESSING_STOPPED | {'timestamp': time.time()})
                     
                 elif action == 'configure':
                     config = data.get('config', {})
-                    session['config'].update(config)
-                    await sio.save_session(sid, session, namespace=self.namespace)
+                    st.config.update(config)
                     
-                    if sid in self.detectors:
-                        self.detectors[sid].update_config(config)
+                    if st.detector is not None:
+                        st.detector.update_config(config)
                     
-                    await sio.emit('status', {
-                        'code': 200,
-                        'message': 'Configuration updated',
-                        'timestamp': time.time()
-                    }, room=sid, namespace=self.namespace)
+                    await st.emit('status', STATUS_CONFIG_UPDATED | {'timestamp': time.time()})
                     
                 else:
-                    await sio.emit('error_message', {
+                    await st.emit('error_message', {
                         'code': 400,
                         'message': f'Unknown action: {action}',
                         'timestamp': time.time()
-                    }, room=sid, namespace=self.namespace)
+                    })
                     
             except Exception as e:
                 logger.error(f"Control error: {str(e)}")
-                await sio.emit('error_message', {
+                await st.emit('error_message', {
                     'code': 500,
                     'message': f'Control error: {str(e)}',
                     'timestamp': time.time()
-                }, room=sid, namespace=self.namespace)
+                })
         
         @sio.event(namespace=self.namespace)
         async def join_room(sid, data):
             """Join a room to share detection results."""
+            st = self.clients.get(sid)
+            if st is None:
+                return
             try:
                 room = data.get('room')
                 if room:
                     await sio.enter_room(sid, room, namespace=self.namespace)
-                    await sio.emit('status', {
+                    await st.emit('status', {
                         'code': 200,
                         'message': f'Joined room: {room}',
                         'timestamp': time.time()
-                    }, room=sid, namespace=self.namespace)
+                    })
                 else:
-                    await sio.emit('error_message', {
-                        'code': 400,
-                        'message': 'Room name is required',
-                        'timestamp': time.time()
-                    }, room=sid, namespace=self.namespace)
+                    await st.emit('error_message', ERROR_ROOM_REQUIRED | {'timestamp': time.time()})
                     
             except Exception as e:
                 logger.error(f"Join room error: {str(e)}")
-                await sio.emit('error_message', {
+                await st.emit('error_message', {
                     'code': 500, 
                     'message': f'Error joining room: {str(e)}',
                     'timestamp': time.time()
-                }, room=sid, namespace=self.namespace)
+                })
         
         @sio.event(namespace=self.namespace)
         async def video_frame(sid, data):
-            """Process video frame and return detection results."""
-            try:
-                session = await sio.get_session(sid, namespace=self.namespace)
-                
-                if not session.get('is_processing', False):
-                    await sio.emit('error_message', {
-                        'code': 400,
-                        'message': 'Processing not started',
-                        'timestamp': time.time()
-                    }, room=sid, namespace=self.namespace)
-                    return
-                
-                if not data or 'data' not in data:
-                    logger.warning(f"No frame data provided from client {sid}")
-                    return
-                
-                frame_id = data.get('frame_id', 'unknown')
-                
-                self.latest_frames[sid] = data
-                
-                if self.processing_frames.get(sid, False):
-                    logger.debug(f"Skipping frame {frame_id} for client {sid}, another frame is being processed")
-                    return
-                    
-                self.processing_frames[sid] = True
-                
-                try:
-                    latest_frame = self.latest_frames[sid]
-
-                    await self._process_frame(sid, latest_frame)
-
-                finally:
-                    self.processing_frames[sid] = False
-                    
-            except Exception as e:
-                logger.error(f"Video frame error: {str(e)}")
-                self.processing_frames[sid] = False
-                await sio.emit('error_message', {
-                    'code': 500,
-                    'message': f'Error processing frame: {str(e)}',
-                    'frame_id': data.get('frame_id') if isinstance(data, dict) else 'unknown',
-                    'timestamp': time.time()
-                }, room=sid, namespace=self.namespace)
+            """Queue the newest video frame for this client's consumer task."""
+            st = self.clients.get(sid)
+            if st is None:
+                return
+            
+            if not st.is_processing:
+                await st.emit('error_message', ERROR_PROCESSING_NOT_STARTED | {'timestamp': time.time()})
+                return
+            
+            frame = self._validate_frame_data(data, sid)
+            if frame is None:
+                return
+            frame_id, payload = frame
+            
+            if st.frame_ready.is_set():
+                logger.debug("Dropping frame %s for client %s, superseded by a newer frame", st.latest_frame[0], sid)
+            # Keep only the base64 payload, not the client's whole message
+            st.latest_frame = (frame_id, data.get('timestamp'), payload)
+            st.frame_ready.set()
 
     async def emit_to_room(self, room: str, event: str, data: Dict[str, Any]):
         """
@@ -280,88 +322,154 @@ class SocketManager:
         """
         Get list of connected clients
         """
-        return list(self.detectors.keys())
+        return list(self.clients.keys())
+
+    async def _consumer_loop(self, sid: str, st: ClientState):
+        """Process frames for one client, always taking the newest one and dropping the rest."""
+        while True:
+            await st.frame_ready.wait()
+            st.frame_ready.clear()
+            frame, st.latest_frame = st.latest_frame, None
+            if frame is None:
+                continue
+            frame_id, timestamp, payload = frame
+            try:
+                await self._process_frame(st, sid, frame_id, timestamp, payload)
+            except Exception as e:
+                logger.error(f"Video frame error: {str(e)}")
+                await st.emit('error_message', {
+                    'code': 500,
+                    'message': f'Error processing frame: {str(e)}',
+                    'frame_id': frame_id,
+                    'timestamp': time.time()
+                })
 
-    async def _process_frame(self, sid: str, frame_data: Dict[str, Any]):
-        """Process video frame using VideoEmotionDetector."""
-        if sid not in self.detectors:
-            session = await sio.get_session(sid, namespace=self.namespace)
-            config = session.get('config', {})
-            self.detectors[sid] = VideoEmotionDetector(config=config)
+    async def _process_frame(self, st: ClientState, sid: str, frame_id: Any, timestamp: Optional[float], payload: FramePayload):
+        """Decode a validated frame off the event loop and process it using VideoEmotionDetector."""
+        detector = st.detector
+        if detector is None:
+            config = st.config
+            detector = st.detector = VideoEmotionDetector(config=config)
             logger.info(f"Initialized new VideoEmotionDetector for client {sid} with config: {config}")
             
-        if not self._validate_frame_data(frame_data, sid):
+        try:
+            loop = asyncio.get_running_loop()
+            # Large client frames are decoded straight to half size instead of decoded then resized
+            reduced = detector.decode_reduced()
+            frame = await loop.run_in_executor(frame_decode_executor, decode_frame, payload, reduced)
+        except ValueError as e:
+            logger.error(f"Invalid frame data from client {sid}: {str(e)}")
             return None
             
         try:
-            result = await self.detectors[sid].process_frame(frame_data)
-            
-            await sio.emit('detection_result', result, room=sid, namespace=self.namespace)
+            result = await detector.process_frame(frame, frame_id, timestamp, 2.0 if reduced else 1.0)
             
-            if self.detectors[sid].frame_count % 30 == 0:
-                metrics = self.detectors[sid].get_performance_metrics()
-                await sio.emit('status', {
-                    'code': 200,
-                    'message': 'Processing metrics',
-                    'timestamp': time.time(),
-                    'metrics': metrics
-                }, room=sid, namespace=self.namespace)
-                
-                if metrics['current_fps'] < 3 and metrics['processed_frames'] > 60:
-                    suggested_config = {}
-                    
-                    current_width, current_height = self.detectors[sid].config['processing_resolution']
-                    if current_width > 320:
-                        suggested_config['processing_resolution'] = (
-                            int(current_width * 0.7),
-                            int(current_height * 0.7)
-                        )
-                    
-                    if suggested_config:
-                        await sio.emit('performance_suggestion', {
-                            'code': 200,
-                            'message': 'Performance optimization suggestion',
-                            'suggested_config': suggested_config,
-                            'timestamp': time.time()
-                        }, room=sid, namespace=self.namespace)
+            depth = self._send_queue_depth(st)
+            if st.dropping_results:
+                if depth <= self.BACKPRESSURE_EXIT:
+                    st.dropping_results = False
+            elif depth > self.BACKPRESSURE_ENTER:
+                logger.warning(f"Client {sid} is not keeping up, dropping detection results")
+                st.dropping_results = True
+            if not st.dropping_results:
+                await st.emit('detection_result', result)
             
             return result
         except Exception as e:
             logger.error(f"Error processing frame for client {sid}: {str(e)}")
-            import traceback
             logger.error(traceback.format_exc())
             return None
             
-    def _validate_frame_data(self, frame_data: Dict[str, Any], sid: str) -> bool:
-        """Validate incoming frame data format."""
-            
-        required_fields = ['data', 'frame_id']
-        for field in required_fields:
-            if field not in frame_data:
-                logger.error(f"Missing required field '{field}' in frame data from client {sid}")
-                return False
+    async def _metrics_loop(self, sid: str, st: ClientState):
+        """Periodically send metrics for one client, off the frame path."""
+        reported_frames = 0
+        while True:
+            await asyncio.sleep(self.METRICS_INTERVAL)
+            detector = st.detector
+            if detector is None or not st.is_processing or st.dropping_results or detector.frame_count == reported_frames:
+                continue
+            reported_frames = detector.frame_count
+            try:
+                await self._emit_metrics(st, detector)
+            except Exception as e:
+                logger.error(f"Metrics emit error for client {sid}: {str(e)}")
+
+    async def _emit_metrics(self, st: ClientState, detector: VideoEmotionDetector):
+        """Emit processing metrics and, when the client is too slow, a lower-resolution suggestion."""
+        metrics = detector.get_performance_metrics()
+        now = time.time()
+        await st.emit('status', {
+            'code': 200,
+            'message': 'Processing metrics',
+            'timestamp': now,
+            'metrics': metrics
+        })
+
+        if metrics['current_fps'] < 3 and metrics['processed_frames'] > 60:
+            suggested_config = {}
+
+            current_width, current_height = detector.config['processing_resolution']
+            if current_width > 320:
+                suggested_config['processing_resolution'] = (
+                    int(current_width * 0.7),
+                    int(current_height * 0.7)
+                )
+
+            if suggested_config:
+                await st.emit('performance_suggestion', {
+                    'code': 200,
+                    'message': 'Performance optimization suggestion',
+                    'suggested_config': suggested_config,
+                    'timestamp': now
+                })
+
+    def _send_queue_depth(self, st: ClientState) -> int:
+        """Number of packets waiting in the client's engine.io send queue."""
+        socket = sio.eio.sockets.get(st.eio_sid) if st.eio_sid else None
+        queue = getattr(socket, 'queue', None)
+        return queue.qsize() if queue is not None else 0
+
+    def _validate_frame_data(self, frame_data: Dict[str, Any], sid: str) -> Optional[Tuple[Any, FramePayload]]:
+        """
+        Validate incoming frame data and return (frame_id, payload). The payload is the raw
+        image bytes of a binary frame, or the base64 string (data URI header stripped) of a legacy frame.
+        """
+        try:
+            base64_data = frame_data['data']
+            frame_id = frame_data['frame_id']
+        except (TypeError, KeyError) as e:
+            logger.error("Invalid frame data from client %s, missing field %s", sid, e)
+            return None
+        
+        if isinstance(base64_data, (bytes, bytearray)):
+            if not base64_data.startswith(IMAGE_MAGIC_NUMBERS):
+                logger.error("Binary frame from client %s is not a JPEG/PNG image", sid)
+                return None
+            return frame_id, base64_data
                 
-        base64_data = frame_data.get('data', '')
-        if not base64_data:
-            logger.error(f"Empty base64 data from client {sid}")
-            return False
+        if not base64_data or not isinstance(base64_data, str):
+            logger.error("Empty base64 data from client %s", sid)
+            return None
+        
+        if not settings.LEGACY_B64_FRAMES:
+            logger.error("Base64 frame from client %s rejected, only binary frames are accepted", sid)
+            return None
             
-        try:
-            if ',' in base64_data:
-                header, base64_data = base64_data.split(',', 1)
-                if not header.startswith('data:image'):
-                    logger.warning(f"Unusual data URI header from client {sid}: {header}")
-                    
-            if len(base64_data) < 100:
-                logger.warning(f"Suspiciously short base64 data from client {sid}: {len(base64_data)} bytes")
-                return False
+        # The data URI header ("data:image/jpeg;base64,") is short: only scan its prefix,
+        # never the whole payload
+        header_end = base64_data.find(',', 0, DATA_URI_HEADER_MAX_LENGTH)
+        if header_end > 0:
+            if not base64_data.startswith('data:image'):
+                logger.warning("Unusual data URI header from client %s: %s", sid, base64_data[:header_end])
+            base64_data = base64_data[header_end + 1:]
+        elif base64_data.startswith('data:'):
+            logger.error("Malformed data URI from client %s", sid)
+            return None
                 
-            import base64
-            base64.b64decode(base64_data[:20])
+        if len(base64_data) < 100:
+            logger.warning("Suspiciously short base64 data from client %s: %d bytes", sid, len(base64_data))
+            return None
             
-            return True
-        except Exception as e:
-            logger.error(f"Invalid base64 data from client {sid}: {str(e)}")
-            return False
+        return frame_id, base64_data
 
 socket_manager = SocketManager() 
\ No newline at end of file
@@ -1,24 +1,63 @@
 import jwt
-from typing import Dict, Any, Optional
-from datetime import datetime, timedelta
+import base64
+import hashlib
+import hmac
+import time
+import uuid
+from collections import OrderedDict
+from jwt.algorithms import HMACAlgorithm
+from typing import Dict, Any, Optional, Tuple
+from datetime import timedelta
 
 from app.core.config import settings
 from app.core.exceptions import AuthenticationException, ValidationException
 
+class KeyedHMACAlgorithm(HMACAlgorithm):
+    """
+    HMACAlgorithm that keys HMAC once and copies the keyed state per token,
+    instead of re-deriving the inner/outer pads from the secret on every sign/verify.
+    """
+    def __init__(self, hash_alg) -> None:
+        super().__init__(hash_alg)
+        self._keyed: Optional[Tuple[bytes, Any]] = None
+
+    def sign(self, msg: bytes, key: bytes) -> bytes:
+        keyed = self._keyed
+        if keyed is None or keyed[0] != key:
+            keyed = self._keyed = (key, hmac.new(key, None, self.hash_alg))
+        mac = keyed[1].copy()
+        mac.update(msg)
+        return mac.digest()
+
+_HMAC_HASHES = {
+    "HS256": HMACAlgorithm.SHA256,
+    "HS384": HMACAlgorithm.SHA384,
+    "HS512": HMACAlgorithm.SHA512,
+}
+if settings.ALGORITHM in _HMAC_HASHES:
+    jwt.unregister_algorithm(settings.ALGORITHM)
+    jwt.register_algorithm(settings.ALGORITHM, KeyedHMACAlgorithm(_HMAC_HASHES[settings.ALGORITHM]))
+
+# Decoded payloads keyed by a digest of the token, so repeated verifications skip HMAC + JSON parsing
+VERIFIED_TOKEN_CACHE_SIZE = 4096
+# Cached entries are dropped this many seconds before the token's own expiry
+VERIFIED_TOKEN_EXP_LEEWAY = 5
+_SECRET_KEY = settings.SECRET_KEY.encode()
+_ALGORITHM = settings.ALGORITHM
+_ALGORITHMS = [_ALGORITHM]
+_ACCESS_TOKEN_TTL = settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+_DECODE_OPTIONS = {"require": ["exp", "sub"], "verify_exp": True}
+_verified_tokens: "OrderedDict[bytes, Tuple[Dict[str, Any], float]]" = OrderedDict()
+
 def create_token(data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
     """
     Create JWT token with provided payload
     """
-    to_encode = data.copy()
+    ttl = int(expires_delta.total_seconds()) if expires_delta else _ACCESS_TOKEN_TTL
+    # Integer NumericDate (RFC 7519) instead of a datetime PyJWT would convert anyway
+    to_encode = {**data, "exp": int(time.time()) + ttl}
     
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    
-    to_encode.update({"exp": expire})
-    
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, _SECRET_KEY, algorithm=_ALGORITHM)
     return encoded_jwt
 
 def verify_token(token: str) -> Dict[str, Any]:
@@ -28,14 +67,72 @@ def verify_token(token: str) -> Dict[str, Any]:
     Raises:
         AuthenticationException: If token is invalid or expired
     """
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    cached = _verified_tokens.get(key)
+    if cached is not None:
+        payload, expires_at = cached
+        if expires_at > time.time() + VERIFIED_TOKEN_EXP_LEEWAY:
+            _verified_tokens.move_to_end(key)
+            return payload
+        _verified_tokens.pop(key, None)
+
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        # PyJWT checks the signature and exp itself; exp and sub must be present
+        payload = jwt.decode(token, _SECRET_KEY, algorithms=_ALGORITHMS, options=_DECODE_OPTIONS)
         
-        if "exp" in payload and datetime.fromtimestamp(payload["exp"]) < datetime.utcnow():
-            raise AuthenticationException("Token expired")
+        _verified_tokens[key] = (payload, float(payload["exp"]))
+        if len(_verified_tokens) > VERIFIED_TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
         
         return payload
+    except jwt.ExpiredSignatureError:
+        raise AuthenticationException("Token expired")
     except jwt.PyJWTError as e:
         raise AuthenticationException(f"Invalid token: {str(e)}")
     except Exception as e:
-        raise AuthenticationException(f"Authentication error: {str(e)}") 
\ No newline at end of file
+        raise AuthenticationException(f"Authentication error: {str(e)}")
+
+
+# Cookie constants
+GUEST_COOKIE_NAME = "guest_usage_info"
+GUEST_COOKIE_MAX_AGE = 60 * 60 * 24 * 3  # 3 days in seconds
+GUEST_COOKIE_REFRESH_AGE = 60 * 60 * 24  # re-issue once a day so active guests keep their id
+
+# Guest cookie: b64url(uuid4 bytes + 4-byte issue time) "." b64url(truncated HMAC-SHA256 tag)
+GUEST_ID_PREFIX = "guest_"
+GUEST_COOKIE_TAG_BYTES = 16
+
+def _guest_cookie_tag(body: bytes) -> bytes:
+    return hmac.new(_SECRET_KEY, body, hashlib.sha256).digest()[:GUEST_COOKIE_TAG_BYTES]
+
+def encode_guest_cookie(guest_id: str) -> str:
+    """
+    Build a signed guest cookie value for a guest id of the form "guest_<uuid>".
+    """
+    body = uuid.UUID(guest_id[len(GUEST_ID_PREFIX):]).bytes + int(time.time()).to_bytes(4, "big")
+    return (base64.urlsafe_b64encode(body).rstrip(b"=") + b"." +
+            base64.urlsafe_b64encode(_guest_cookie_tag(body)).rstrip(b"=")).decode()
+
+def read_guest_cookie(cookie: str, max_age: int) -> Optional[Tuple[str, int]]:
+    """
+    Return (guest id, issue time) from a signed guest cookie, or None if it is malformed, tampered with or older than max_age seconds.
+    """
+    try:
+        body_b64, tag_b64 = cookie.encode().split(b".")
+        body = base64.urlsafe_b64decode(body_b64 + b"==")
+        tag = base64.urlsafe_b64decode(tag_b64 + b"==")
+    except ValueError:
+        return None
+    if len(body) != 20 or not hmac.compare_digest(tag, _guest_cookie_tag(body)):
+        return None
+    issued_at = int.from_bytes(body[16:], "big")
+    if time.time() - issued_at > max_age:
+        return None
+    return f"{GUEST_ID_PREFIX}{uuid.UUID(bytes=body[:16])}", issued_at
+
+def decode_guest_cookie(cookie: str, max_age: int) -> Optional[str]:
+    """
+    Return the guest id from a signed guest cookie, or None if it is not valid.
+    """
+    guest = read_guest_cookie(cookie, max_age)
+    return guest[0] if guest else None
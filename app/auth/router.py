@@ -1,66 +1,98 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Cookie, Response, Body
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Cookie, Response, Body
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import Optional
-from datetime import datetime, timedelta
+from fastapi.responses import ORJSONResponse
+from typing import Optional, Tuple
+import asyncio
+import hashlib
+import math
+import time
+import concurrent.futures
+import functools
+from datetime import datetime, timedelta, timezone
 import firebase_admin
 from firebase_admin import credentials, auth as firebase_auth
-from jose import jwt, JWTError
-import json
+import jwt
+from jwt import PyJWTError as JWTError, ExpiredSignatureError
 import uuid
 from app.core.config import settings
 from app.domain.models.user import User, FirebaseToken
 from app.infrastructure.database.repository import get_refresh_token_repository
-from jose import ExpiredSignatureError
+from app.auth.auth_utils import (
+    GUEST_COOKIE_NAME, GUEST_COOKIE_MAX_AGE, GUEST_COOKIE_REFRESH_AGE, GUEST_ID_PREFIX,
+    encode_guest_cookie, read_guest_cookie
+)
+from app.core.logging import get_logger
+from cachetools import TLRUCache, TTLCache
 
-router = APIRouter()
+logger = get_logger("auth")
+
+router = APIRouter(default_response_class=ORJSONResponse)
 oauth2_scheme = HTTPBearer(auto_error=False)
 
 # Initialize Firebase 
 firebase_app = None
 
 def init_firebase():
+    """
+    Initialize the Firebase Admin app once. Called from the application lifespan.
+    """
     global firebase_app
+    if firebase_app is not None:
+        return
     cred_dict = settings.get_firebase_credential_dict()
-    if firebase_app is None and cred_dict:
+    if cred_dict:
         try:
             cred = credentials.Certificate(cred_dict)
             firebase_app = firebase_admin.initialize_app(cred)
-            print("Firebase initialized successfully")
+            logger.info("Firebase initialized successfully")
         except Exception as e:
-            print(f"Firebase initialization error: {e}")
+            logger.error("Firebase initialization error: %s", e)
             raise
 
-# Call init_firebase at startup
-init_firebase()
+# Prepared once; HS* signing reuses the keyed HMAC state registered in app.auth.auth_utils
+JWT_KEY = settings.SECRET_KEY.encode()
+JWT_ALGORITHM = settings.ALGORITHM
+JWT_ALGORITHMS = [JWT_ALGORITHM]
+ACCESS_TOKEN_TTL_SECONDS = settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+REFRESH_TOKEN_TTL_SECONDS = 7 * 24 * 60 * 60
+GUEST_MAX_USAGE = settings.GUEST_MAX_USAGE
 
-# Cookie constants
-GUEST_COOKIE_NAME = "guest_usage_info"
-GUEST_COOKIE_MAX_AGE = 60 * 60 * 24 * 3  # 3 days in seconds
+# Blocking Firebase Admin calls run here, bounded and apart from the default executor
+firebase_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.FIREBASE_WORKERS,
+    thread_name_prefix="firebase"
+)
 
 def create_access_token(user_data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
     Create a JWT access token for API, always has 'sub' (user_id) and 'exp'.
     """
-    to_encode = user_data.copy()
+    ttl = int(expires_delta.total_seconds()) if expires_delta else ACCESS_TOKEN_TTL_SECONDS
+    to_encode = {**user_data, "exp": int(time.time()) + ttl}
     if "sub" not in to_encode and "user_id" in to_encode:
         to_encode["sub"] = to_encode["user_id"]
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, JWT_KEY, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
 def create_refresh_token(user_data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
     Tạo một JWT refresh token cho API, luôn có 'sub' (user_id), 'exp' và 'type'.
     """
-    to_encode = user_data.copy()
+    ttl = int(expires_delta.total_seconds()) if expires_delta else REFRESH_TOKEN_TTL_SECONDS
+    to_encode = {**user_data, "exp": int(time.time()) + ttl, "type": "refresh"}
     if "sub" not in to_encode and "user_id" in to_encode:
         to_encode["sub"] = to_encode["user_id"]
-    expire = datetime.utcnow() + (expires_delta or timedelta(days=7))
-    to_encode.update({"exp": expire, "type": "refresh"})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, JWT_KEY, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
+GUEST_COOKIE_KWARGS = dict(
+    key=GUEST_COOKIE_NAME,
+    max_age=GUEST_COOKIE_MAX_AGE,
+    httponly=True,
+    samesite="none",
+    secure=True
+)
+
 def get_or_create_guest_user(
     response: Response, 
     guest_cookie: Optional[str] = None
@@ -68,36 +100,18 @@ def get_or_create_guest_user(
     """
     Get user info from cookie or create a new guest user.
     """
-    guest_info = {}
-    guest_id = None
-    
-    # Try to parse the cookie if it exists
-    if guest_cookie:
-        try:
-            guest_info = json.loads(guest_cookie)
-            guest_id = guest_info.get("guest_id")
-        except (json.JSONDecodeError, ValueError):
-            pass
+    guest = read_guest_cookie(guest_cookie, GUEST_COOKIE_MAX_AGE) if guest_cookie else None
     
     # Create a new guest ID if needed
-    if not guest_id:
-        guest_id = f"guest_{uuid.uuid4()}"
-        
-    # Update and set the cookie
-    guest_info = {
-        "guest_id": guest_id,
-        "last_used": datetime.now().isoformat()
-    }
+    if guest is None:
+        guest_id = f"{GUEST_ID_PREFIX}{uuid.uuid4()}"
+        issued_at = 0
+    else:
+        guest_id, issued_at = guest
     
-    # Set/update the cookie
-    response.set_cookie(
-        key=GUEST_COOKIE_NAME,
-        value=json.dumps(guest_info),
-        max_age=GUEST_COOKIE_MAX_AGE,
-        httponly=True,
-        samesite="none",
-        secure=True
-    )
+    # Only (re)issue the cookie when it is new or getting old, not on every request
+    if time.time() - issued_at > GUEST_COOKIE_REFRESH_AGE:
+        response.set_cookie(value=encode_guest_cookie(guest_id), **GUEST_COOKIE_KWARGS)
     
     return User(
         user_id=guest_id,
@@ -107,12 +121,15 @@ def get_or_create_guest_user(
         last_used=datetime.now()
     )
 
-def verify_firebase_token(id_token: str) -> dict:
+async def verify_firebase_token(id_token: str) -> dict:
     """
-    Verify Firebase token.
+    Verify Firebase token. The Admin SDK call blocks (it may refetch Google's public keys),
+    so it runs in a worker thread.
     """
     try:
-        decoded_token = firebase_auth.verify_id_token(id_token)
+        decoded_token = await asyncio.get_running_loop().run_in_executor(
+            firebase_executor, functools.partial(firebase_auth.verify_id_token, id_token, app=firebase_app)
+        )
         return decoded_token
     except ValueError as e:
 
@@ -121,12 +138,22 @@ def verify_firebase_token(id_token: str) -> dict:
         # Return error instead of raising exception
         raise ValueError(f"Token verification failed: {str(e)}")
 
-def get_user_from_firebase(firebase_user_id: str) -> dict:
+# uid -> Firebase UserRecord, so repeated lookups within the TTL skip the Admin API call
+firebase_user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=120)
+
+async def get_user_from_firebase(firebase_user_id: str) -> dict:
     """
-    Get user info from Firebase by user ID.
+    Get user info from Firebase by user ID (network call, run in a worker thread).
     """
     try:
-        user = firebase_auth.get_user(firebase_user_id)
+        return firebase_user_cache[firebase_user_id]
+    except KeyError:
+        pass
+    try:
+        user = await asyncio.get_running_loop().run_in_executor(
+            firebase_executor, functools.partial(firebase_auth.get_user, firebase_user_id, app=firebase_app)
+        )
+        firebase_user_cache[firebase_user_id] = user
         return user
     except firebase_auth.UserNotFoundError:
         raise HTTPException(
@@ -134,7 +161,7 @@ def get_user_from_firebase(firebase_user_id: str) -> dict:
             detail=f"User not found: {firebase_user_id}"
         )
     except Exception as e:
-        print(f"Error retrieving user from Firebase: {e}")
+        logger.error("Error retrieving user from Firebase: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Could not retrieve user data"
@@ -144,23 +171,133 @@ def format_firebase_user(firebase_user) -> User:
     """
     Format data from Firebase user to application format.
     """
-    providers = [
-        provider.provider_id for provider in getattr(firebase_user, "provider_data", [])
-    ]
+    # UserRecord always defines these attributes (None when unset)
+    providers = [provider.provider_id for provider in firebase_user.provider_data or ()]
     
-    return User(
+    # Trusted Firebase data: skip validation
+    return User.model_construct(
         user_id=firebase_user.uid,
-        email=getattr(firebase_user, "email", ""),
-        display_name=getattr(firebase_user, "display_name", None),
-        photo_url=getattr(firebase_user, "photo_url", None),
+        email=firebase_user.email or "",
+        display_name=firebase_user.display_name,
+        photo_url=firebase_user.photo_url,
         is_guest=False,
-        is_email_verified=getattr(firebase_user, "email_verified", False),
+        is_email_verified=bool(firebase_user.email_verified),
         providers=providers,
         usage_count=0,
         last_used=datetime.now(),
         created_at=datetime.fromtimestamp(firebase_user.user_metadata.creation_timestamp / 1000)
     )
 
+def user_token_claims(firebase_user) -> dict:
+    """
+    Profile claims embedded in our access tokens, so authenticated requests need no Firebase lookup.
+    """
+    created_at_ms = firebase_user.user_metadata.creation_timestamp
+    return {
+        "sub": firebase_user.uid,
+        "email": firebase_user.email or "",
+        "name": firebase_user.display_name,
+        "picture": firebase_user.photo_url,
+        "email_verified": bool(firebase_user.email_verified),
+        "providers": [provider.provider_id for provider in firebase_user.provider_data or ()],
+        "created_at": created_at_ms // 1000 if created_at_ms else None
+    }
+
+def user_from_token_claims(payload: dict) -> User:
+    """
+    Build the user from an access token issued with user_token_claims.
+    """
+    created_at = payload.get("created_at")
+    # Claims come from a token we signed: skip validation
+    return User.model_construct(
+        user_id=payload["sub"],
+        email=payload["email"],
+        display_name=payload.get("name"),
+        photo_url=payload.get("picture"),
+        is_guest=False,
+        is_email_verified=payload.get("email_verified", False),
+        providers=payload.get("providers", []),
+        usage_count=0,
+        last_used=datetime.now(),
+        created_at=datetime.fromtimestamp(created_at) if created_at else None
+    )
+
+# Token digest -> (User or None, token exp) so repeated requests skip signature checks and
+# Firebase lookups. Entries live TOKEN_USER_CACHE_TTL seconds (failures: TOKEN_USER_NEGATIVE_TTL),
+# never past the token's own expiry.
+TOKEN_USER_CACHE_TTL = 60
+TOKEN_USER_NEGATIVE_TTL = 10
+
+def _token_user_ttu(_key, value, now):
+    user, expires_at = value
+    return min(now + (TOKEN_USER_CACHE_TTL if user is not None else TOKEN_USER_NEGATIVE_TTL), expires_at)
+
+token_user_cache: TLRUCache = TLRUCache(maxsize=10_000, ttu=_token_user_ttu, timer=time.time)
+
+async def resolve_token_user(token_value: str) -> Optional[User]:
+    """
+    Resolve a bearer token (API JWT or Firebase ID token) to a user, cached in token_user_cache.
+    """
+    key = hashlib.sha256(token_value.encode()).digest()[:16]
+    try:
+        return token_user_cache[key][0]
+    except KeyError:
+        pass
+    user, expires_at = await _resolve_token_user(token_value)
+    token_user_cache[key] = (user, expires_at)
+    return user
+
+async def _resolve_token_user(token_value: str) -> Tuple[Optional[User], float]:
+    try:
+        header = jwt.get_unverified_header(token_value)
+    except JWTError:
+        return None, math.inf
+    
+    # Our tokens are HS* without a kid; Firebase ID tokens are RS256 with one
+    if header.get("alg") == JWT_ALGORITHM and "kid" not in header:
+        try:
+            payload = jwt.decode(token_value, JWT_KEY, algorithms=JWT_ALGORITHMS)
+        except JWTError:
+            return None, math.inf
+        user_id = payload.get("sub")
+        expires_at = payload.get("exp", math.inf)
+        if user_id and "email" in payload:
+            return user_from_token_claims(payload), expires_at
+        if user_id:
+            # Tokens issued before profile claims were added
+            firebase_user = await get_user_from_firebase(user_id)
+            return format_firebase_user(firebase_user), expires_at
+        return None, math.inf
+    
+    try:
+        firebase_data = await verify_firebase_token(token_value)
+        firebase_user = await get_user_from_firebase(firebase_data["uid"])
+        return format_firebase_user(firebase_user), firebase_data.get("exp", math.inf)
+    except ValueError as e:
+        logger.debug("Firebase token format error: %s", e)
+    return None, math.inf
+
+def invalidate_user_tokens(user_id: str) -> None:
+    """
+    Drop cached token resolutions and the cached Firebase record belonging to a user.
+    """
+    firebase_user_cache.pop(user_id, None)
+    for key, (user, _) in list(token_user_cache.items()):
+        if user is not None and user.user_id == user_id:
+            token_user_cache.pop(key, None)
+
+async def user_from_credentials(token: Optional[HTTPAuthorizationCredentials]) -> Optional[User]:
+    """
+    Resolve the bearer credentials to a user, or None if missing/invalid.
+    """
+    if not token:
+        return None
+    try:
+        return await resolve_token_user(token.credentials)
+    except Exception as e:
+        logger.debug("Authentication error: %s", e)
+    return None
+
 async def get_current_user(
     response: Response,
     token: Optional[HTTPAuthorizationCredentials] = Depends(oauth2_scheme),
@@ -169,59 +306,59 @@ async def get_current_user(
     """
     Get current user info from token or cookie.
     """
-    if token:
-        token_value = token.credentials
-        try:
-            try:
-                payload = jwt.decode(token_value, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-                user_id = payload.get("sub")
-                if user_id:
-                    firebase_user = get_user_from_firebase(user_id)
-                    return format_firebase_user(firebase_user)
-            except JWTError:
-                try:
-                    firebase_data = verify_firebase_token(token_value)
-                    firebase_user = get_user_from_firebase(firebase_data["uid"])
-                    return format_firebase_user(firebase_user)
-                except ValueError as e:
-                    print(f"Firebase token format error: {e}")
-        except Exception as e:
-            print(f"Authentication error: {str(e)}")
+    user = await user_from_credentials(token)
+    if user:
+        return user
     
     # If no token or token validation failed, create or get guest user
     return get_or_create_guest_user(response, guest_cookie)
 
+async def require_authenticated_user(
+    token: Optional[HTTPAuthorizationCredentials] = Depends(oauth2_scheme)
+) -> User:
+    """
+    Like get_current_user, but rejects guests with 401 before any guest handling.
+    """
+    user = await user_from_credentials(token)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Authentication required."
+        )
+    return user
+
 
 @router.post("/verify-token")
-async def verify_token(token_data: FirebaseToken):
+async def verify_token(token_data: FirebaseToken, background_tasks: BackgroundTasks):
     """
     Verify Firebase token and return user info.
     """
     try:
         try:
-            decoded_token = verify_firebase_token(token_data.id_token)
+            decoded_token = await verify_firebase_token(token_data.id_token)
         except ValueError as e:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail=str(e)
             )
             
-        user = get_user_from_firebase(decoded_token["uid"])
+        user = await get_user_from_firebase(decoded_token["uid"])
         user_uid = user["uid"] if isinstance(user, dict) and "uid" in user else getattr(user, "uid", None)
         if not user_uid:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid user object returned from Firebase"
             )
-        access_token = create_access_token({"sub": user_uid})
+        access_token = create_access_token(user_token_claims(user))
         refresh_token = create_refresh_token({"sub": user_uid})
-        # Save refresh_token to MongoDB
+        # Save refresh_token after the response is sent; the client does not wait on the write
+        now = datetime.now(timezone.utc)
         repo = get_refresh_token_repository()
-        await repo.create({
+        background_tasks.add_task(repo.create, {
             "refresh_token": refresh_token,
             "user_id": user_uid,
-            "created_at": datetime.utcnow(),
-            "expires_at": datetime.utcnow() + timedelta(days=7)
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=REFRESH_TOKEN_TTL_SECONDS)
         })
         return {
             "message": "Token verified",
@@ -231,7 +368,7 @@ async def verify_token(token_data: FirebaseToken):
             "token_type": "bearer"
         }
     except Exception as e:
-        print(f"Token verification error: {e}")
+        logger.warning("Token verification error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"Invalid token: {str(e)}"
@@ -253,7 +390,7 @@ async def get_usage(current_user: User = Depends(get_current_user)):
         "user_id": current_user.user_id,
         "is_guest": current_user.is_guest,
         "usage_count": 0 if current_user.is_guest else current_user.usage_count,
-        "max_usage": None if not current_user.is_guest else settings.GUEST_MAX_USAGE
+        "max_usage": None if not current_user.is_guest else GUEST_MAX_USAGE
     }
 
 @router.post("/refresh-token")
@@ -265,7 +402,7 @@ async def refresh_token(
     """
     repo = get_refresh_token_repository()
     try:
-        payload = jwt.decode(refresh_token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = jwt.decode(refresh_token, JWT_KEY, algorithms=JWT_ALGORITHMS)
         user_id = payload.get("sub")
         token_type = payload.get("type")
         
@@ -275,7 +412,8 @@ async def refresh_token(
         
         if not token_doc or token_doc.get("user_id") != user_id:
             raise HTTPException(status_code=401, detail="Invalid refresh token")
-        access_token = create_access_token({"sub": user_id})
+        # One Firebase lookup per refresh keeps the profile claims current
+        access_token = create_access_token(user_token_claims(await get_user_from_firebase(user_id)))
         return {"access_token": access_token, "token_type": "bearer"}
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Refresh token expired")
@@ -288,6 +426,6 @@ async def reset_refresh_tokens(current_user: User = Depends(get_current_user)):
     Delete all refresh tokens of current user from MongoDB.
     """
     repo = get_refresh_token_repository()
-    collection = repo.collection
-    result = await collection.delete_many({"user_id": current_user.user_id})
-    return {"message": f"Deleted {result.deleted_count} refresh tokens for user {current_user.user_id}"}
+    deleted_count = await repo.delete_by_user(current_user.user_id)
+    invalidate_user_tokens(current_user.user_id)
+    return {"message": f"Deleted {deleted_count} refresh tokens for user {current_user.user_id}"}
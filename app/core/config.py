@@ -1,5 +1,5 @@
 import os
-from pydantic import ConfigDict
+from pydantic import ConfigDict, PrivateAttr
 from pydantic_settings import BaseSettings
 from typing import Optional
 from dotenv import load_dotenv
@@ -29,6 +29,24 @@ class Settings(BaseSettings):
     # MongoDB settings
     MONGODB_URI: str = os.getenv("MONGODB_URI", "")
     MONGODB_NAME: str = os.getenv("MONGODB_NAME", "emotion_detection")
+    MONGODB_MIN_POOL_SIZE: int = int(os.getenv("MONGODB_MIN_POOL_SIZE", "10"))
+    MONGODB_MAX_POOL_SIZE: int = int(os.getenv("MONGODB_MAX_POOL_SIZE", "50"))
+    MONGODB_MAX_IDLE_TIME_MS: int = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "300000"))
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS: int = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+    DETECTION_SAVE_BATCH_SIZE: int = int(os.getenv("DETECTION_SAVE_BATCH_SIZE", "100"))
+    DETECTION_SAVE_FLUSH_MS: int = int(os.getenv("DETECTION_SAVE_FLUSH_MS", "50"))
+    # Re-uploads of the same image by the same user return the stored result for this long
+    DETECTION_RESULT_CACHE_SIZE: int = int(os.getenv("DETECTION_RESULT_CACHE_SIZE", "2048"))
+    DETECTION_RESULT_CACHE_TTL: int = int(os.getenv("DETECTION_RESULT_CACHE_TTL", "3600"))
+    
+    # Socket.IO packet serializer: "default" (JSON via orjson) or "msgpack" (clients need
+    # socket.io-msgpack-parser)
+    SOCKETIO_SERIALIZER: str = os.getenv("SOCKETIO_SERIALIZER", "default")
+    # Polling responses larger than this many bytes are gzip/deflate compressed
+    SOCKETIO_COMPRESSION_THRESHOLD: int = int(os.getenv("SOCKETIO_COMPRESSION_THRESHOLD", "256"))
+    
+    # Redis (optional): when set, Socket.IO rooms/emits are shared across workers
+    REDIS_URL: Optional[str] = os.getenv("REDIS_URL")
     
     # Cloudinary settings
     CLOUDINARY_CLOUD_NAME: str = os.getenv("CLOUDINARY_CLOUD_NAME", "")
@@ -38,11 +56,16 @@ class Settings(BaseSettings):
     # Firebase settings
     FIREBASE_SERVICE_ACCOUNT_B64: str = os.getenv("FIREBASE_SERVICE_ACCOUNT_B64", "")
 
+    # Decoded once, then the same dict is returned on every call
+    _firebase_credential_dict: Optional[dict] = PrivateAttr(default=None)
+    
     def get_firebase_credential_dict(self):
         if not self.FIREBASE_SERVICE_ACCOUNT_B64:
             return None
-        decoded = base64.b64decode(self.FIREBASE_SERVICE_ACCOUNT_B64)
-        return json.loads(decoded)
+        if self._firebase_credential_dict is None:
+            decoded = base64.b64decode(self.FIREBASE_SERVICE_ACCOUNT_B64)
+            self._firebase_credential_dict = json.loads(decoded)
+        return self._firebase_credential_dict
     
     # Hugging Face model
     HUGGINGFACE_MODEL: str = os.getenv("HUGGINGFACE_MODEL", "dima806/facial_emotions_image_detection")
@@ -56,6 +79,21 @@ class Settings(BaseSettings):
     GUEST_MAX_USAGE: int = int(os.getenv("GUEST_MAX_USAGE", "3"))
     GUEST_WINDOW_SECONDS: int = int(os.getenv("GUEST_WINDOW_SECONDS", "86400"))  # 1 day
     MAX_BATCH_SIZE: int = int(os.getenv("MAX_BATCH_SIZE", "4"))
+    BATCH_DETECT_CONCURRENCY: int = int(os.getenv("BATCH_DETECT_CONCURRENCY", "2"))  # detections run at once per batch request
+    MAX_IMAGE_BYTES: int = int(os.getenv("MAX_IMAGE_BYTES", str(5 * 1024 * 1024)))  # per uploaded image
+    
+    # Inference settings
+    INFERENCE_WORKERS: int = int(os.getenv("INFERENCE_WORKERS", "2"))
+    FIREBASE_WORKERS: int = int(os.getenv("FIREBASE_WORKERS", "32"))
+    REALTIME_DETECT_WORKERS: int = int(os.getenv("REALTIME_DETECT_WORKERS", "4"))
+    REALTIME_BATCH_WAIT_MS: int = int(os.getenv("REALTIME_BATCH_WAIT_MS", "10"))
+    REALTIME_BATCH_MAX_FACES: int = int(os.getenv("REALTIME_BATCH_MAX_FACES", "32"))
+    # Accept base64 data-URI frames from older realtime clients (binary frames are always accepted)
+    LEGACY_B64_FRAMES: bool = os.getenv("LEGACY_B64_FRAMES", "True").lower() == "true"
+    # Realtime backpressure (engine.io packets queued per client): start dropping results above
+    # ENTER, resume once the queue has drained to EXIT
+    REALTIME_BACKPRESSURE_ENTER: int = int(os.getenv("REALTIME_BACKPRESSURE_ENTER", "4"))
+    REALTIME_BACKPRESSURE_EXIT: int = int(os.getenv("REALTIME_BACKPRESSURE_EXIT", "0"))
     
     # Logging settings
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
@@ -1,5 +1,7 @@
 import logging
 import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 import json
 import os
 from datetime import datetime
@@ -7,9 +9,24 @@ from typing import Dict, Any, Optional
 from pathlib import Path
 import re
 
+import orjson
+
 from app.core.config import settings
 
 
+class LocalQueueHandler(QueueHandler):
+    """
+    QueueHandler for an in-process listener: enqueues the record untouched so
+    JsonFormatter still sees exc_info and extra fields on the listener thread.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_file_listener: Optional[QueueListener] = None
+_queue_handler: Optional[LocalQueueHandler] = None
+
+
 class JsonFormatter(logging.Formatter):
     """
     Custom formatter that outputs log records as JSON objects.
@@ -18,6 +35,14 @@ class JsonFormatter(logging.Formatter):
     LARGE_DATA_FIELDS = ['data', 'image', 'frame', 'base64', 'content']
     BASE64_PATTERN = re.compile(r'[A-Za-z0-9+/]{50,}={0,2}')
     MAX_STRING_LENGTH = 1000
+    RESERVED_ATTRS = frozenset({
+        "args", "asctime", "created", "exc_info", "exc_text",
+        "filename", "funcName", "id", "levelname", "levelno",
+        "lineno", "module", "msecs", "message", "msg",
+        "name", "pathname", "process", "processName",
+        "relativeCreated", "stack_info", "thread", "threadName",
+        "extra", "taskName"
+    })
     
     def format(self, record: logging.LogRecord) -> str:
         """
@@ -37,34 +62,23 @@ class JsonFormatter(logging.Formatter):
                 "message": str(record.exc_info[1]) if record.exc_info[1] else "",
                 "traceback": self.formatException(record.exc_info)
             }
-        extra_dict = {}
-        for key in dir(record):
-            if key.startswith('_extra_') and not key.startswith('__'):
-                extra_dict[key[7:]] = getattr(record, key)
-                
-        if extra_dict:
-            extra_dict = self.sanitize_dict(extra_dict)
-            log_entry["extra"] = extra_dict
             
-        # Add any additional attributes from the record
+        # Context passed through ContextLogger / extra= lands on the record as attributes
         for key, value in record.__dict__.items():
-            if key not in ["args", "asctime", "created", "exc_info", "exc_text", 
-                           "filename", "funcName", "id", "levelname", "levelno", 
-                           "lineno", "module", "msecs", "message", "msg", 
-                           "name", "pathname", "process", "processName", 
-                           "relativeCreated", "stack_info", "thread", "threadName",
-                           "extra"]:
-                try:
-                    if isinstance(value, dict):
-                        value = self.sanitize_dict(value)
-                    elif isinstance(value, str):
-                        value = self.sanitize_string(value)
-                    json.dumps({key: value})
-                    log_entry[key] = value
-                except (TypeError, OverflowError):
-                    log_entry[key] = str(value)
+            if key in self.RESERVED_ATTRS:
+                continue
+            if isinstance(value, dict):
+                value = self.sanitize_dict(value)
+            elif isinstance(value, str):
+                value = self.sanitize_string(value)
+            log_entry[key] = value
                     
-        return json.dumps(log_entry)
+        # Anything orjson can't encode is written as str(value)
+        try:
+            return orjson.dumps(log_entry, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        except orjson.JSONEncodeError:
+            # e.g. tuple dict keys or ints wider than 64 bits: slower stdlib path, but keep the line
+            return json.dumps(log_entry, default=str, skipkeys=True)
         
     def sanitize_dict(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -75,7 +89,7 @@ class JsonFormatter(logging.Formatter):
             
         result = {}
         for key, value in data.items():
-            if any(field in key.lower() for field in self.LARGE_DATA_FIELDS):
+            if any(field in str(key).lower() for field in self.LARGE_DATA_FIELDS):
                 if isinstance(value, str):
                     length = len(value)
                     result[key] = f"[LARGE DATA REMOVED: {length} bytes]"
@@ -119,6 +133,7 @@ def setup_logging() -> logging.Logger:
     app_logger.setLevel(log_level)
     app_logger.propagate = False
     
+    stop_logging()
     if app_logger.handlers:
         app_logger.handlers.clear()
     
@@ -131,19 +146,48 @@ def setup_logging() -> logging.Logger:
     console_handler.setFormatter(console_formatter)
     app_logger.addHandler(console_handler)
     
-    # File handler with JSON formatting for easier parsing
+    # File handler with JSON formatting for easier parsing; writes happen on the
+    # QueueListener thread so request code only enqueues the record
     if getattr(settings, "LOG_TO_FILE", True):
+        global _file_listener, _queue_handler
         log_file = log_dir / f"{datetime.now().strftime('%Y-%m-%d')}.log"
         file_handler = logging.FileHandler(log_file)
         file_handler.setLevel(log_level)
         file_handler.setFormatter(JsonFormatter())
-        app_logger.addHandler(file_handler)
+        log_queue: SimpleQueue = SimpleQueue()
+        _file_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+        _file_listener.start()
+        _queue_handler = LocalQueueHandler(log_queue)
+        _queue_handler.setLevel(log_level)
+        app_logger.addHandler(_queue_handler)
     
     setup_module_loggers(log_level)
     
     return app_logger
 
 
+def stop_logging() -> None:
+    """
+    Stop the background file-log listener, if running. Loggers are switched back to
+    writing the file directly, then the listener drains what is still queued.
+    """
+    global _file_listener, _queue_handler
+    if _file_listener is None:
+        return
+    file_handler = _file_listener.handlers[0]
+    loggers = [logging.getLogger("app")] + [
+        module_logger for module_logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(module_logger, logging.Logger)
+    ]
+    for module_logger in loggers:
+        if _queue_handler in module_logger.handlers:
+            module_logger.removeHandler(_queue_handler)
+            module_logger.addHandler(file_handler)
+    _file_listener.stop()
+    _file_listener = None
+    _queue_handler = None
+
+
 def setup_module_loggers(default_level: int) -> None:
     """
     Set up loggers for specific modules.
@@ -7,7 +7,9 @@ from app.core.exceptions import RateLimitException
 from app.core.config import settings
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.types import ASGIApp
+from starlette.datastructures import Headers
 from app.core.rate_limit import get_rate_limiter
+from app.auth.auth_utils import GUEST_COOKIE_NAME, GUEST_COOKIE_MAX_AGE, decode_guest_cookie
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.core.exceptions import AppBaseException
@@ -104,6 +106,42 @@ class ErrorHandlingMiddleware:
             response = await exception_handler(request, exc)
             await response(scope, receive, send)
 
+class UploadSizeLimitMiddleware:
+    """
+    Reject image uploads whose Content-Length is already too large,
+    before the multipart body is read and spooled.
+    The batch endpoint is bounded here as a whole (max_batch_size images);
+    each of its files is still checked against MAX_IMAGE_BYTES while it is staged.
+    """
+    # Room for the multipart boundary and part headers around the file
+    FORM_OVERHEAD_BYTES = 64 * 1024
+
+    def __init__(self, app: ASGIApp, max_image_bytes: int, max_batch_size: int = 1):
+        self.app = app
+        self.max_image_bytes = max_image_bytes
+        max_body_bytes = max_image_bytes + self.FORM_OVERHEAD_BYTES
+        self.max_body_bytes_by_path = {
+            f"{settings.API_PREFIX}/detect": max_body_bytes,
+            f"{settings.API_PREFIX}/detect/batch": max_body_bytes * max_batch_size,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            max_body_bytes = self.max_body_bytes_by_path.get(scope["path"])
+            if max_body_bytes is not None:
+                content_length = Headers(scope=scope).get("content-length")
+                if content_length and content_length.isdigit() and int(content_length) > max_body_bytes:
+                    # Same {"detail": ...} shape as the routes' own 413
+                    response = JSONResponse(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        content={
+                            "detail": f"Upload exceeds maximum allowed size ({self.max_image_bytes / 1024:.1f} KB per image)"
+                        }
+                    )
+                    await response(scope, receive, send)
+                    return
+        await self.app(scope, receive, send)
+
 class RateLimitMiddleware(BaseHTTPMiddleware):
     """
     Middleware to limit the number of requests from an IP (or guest_id) for sensitive endpoints.
@@ -119,16 +157,13 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
             if auth_header and auth_header.startswith("Bearer "):
                 return await call_next(request)
             
-            guest_cookie = request.cookies.get("guest_usage_info")
+            guest_cookie = request.cookies.get(GUEST_COOKIE_NAME)
             guest_id = None
             if guest_cookie:
-                try:
-                    import json
-                    guest_info = json.loads(guest_cookie)
-                    guest_id = guest_info.get("guest_id")
-                except Exception:
-                    pass
-            else:
+                guest_id = decode_guest_cookie(guest_cookie, GUEST_COOKIE_MAX_AGE)
+            # Missing, pre-signing (plain JSON), tampered or expired cookies are all treated
+            # as no cookie: never rate-limit on a shared None key
+            if guest_id is None:
                 return JSONResponse(
                     status_code=status.HTTP_403_FORBIDDEN,
                     content={
@@ -2,7 +2,7 @@ import time
 from typing import List, Optional
 from app.infrastructure.database.repository import get_rate_limit_repository
 from app.core.logging import logger
-from app.domain.models.rate_limit import RateLimit, RateLimitInfo
+from app.domain.models.rate_limit import RateLimitInfo
 
 class MongoRateLimiter:
     """
@@ -26,31 +26,10 @@ class MongoRateLimiter:
         now = time.time()
         window_start = now - window_seconds
         
-        rate_limit_doc = await repository.get_by_key(key)
-        
-        if not rate_limit_doc:
-            rate_limit = RateLimit(
-                key=key,
-                timestamps=[now],
-                last_updated=now
-            )
-            await repository.create(rate_limit.model_dump())
-            return False
-        
-        timestamps: List[float] = rate_limit_doc.get("timestamps", [])
-        valid_timestamps = [ts for ts in timestamps if ts > window_start]
-        
-        is_rate_limited = len(valid_timestamps) >= max_requests
+        # Single atomic round-trip: safe across uvicorn workers
+        rate_limit_doc = await repository.record_request(key, now, window_start, max_requests)
         
-        if not is_rate_limited:
-            valid_timestamps.append(now)
-        
-        rate_limit = RateLimit(
-            key=key,
-            timestamps=valid_timestamps,
-            last_updated=now
-        )
-        await repository.update(key, rate_limit.model_dump())
+        is_rate_limited = not rate_limit_doc.get("last_allowed", False)
         
         if is_rate_limited:
             logger.warning(f"Rate limit exceeded for {key}: {max_requests} requests per {window_seconds} seconds")
@@ -1,8 +1,14 @@
 # Abstract base repository and concrete repositories for MongoDB access
 from abc import ABC, abstractmethod
+from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
+import hashlib
+import time
 from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
 from app.services.database import get_collection
+from app.services.redis_client import get_redis
+from app.core.config import settings
 
 class Repository(ABC):
     def __init__(self, collection: AsyncIOMotorCollection):
@@ -28,10 +34,21 @@ class DetectionRepository(Repository):
     async def get_by_id(self, id: Any) -> Optional[Dict]:
         return await self.collection.find_one({'_id': id})
 
+    async def get_by_id_for_user(self, id: Any, user_id: str) -> Optional[Dict]:
+        return await self.collection.find_one({'_id': id, 'user_id': user_id})
+
+    async def delete_for_user(self, id: Any, user_id: str) -> bool:
+        result = await self.collection.delete_one({'_id': id, 'user_id': user_id})
+        return result.deleted_count > 0
+
     async def create(self, data: Dict) -> Any:
         result = await self.collection.insert_one(data)
         return result.inserted_id
 
+    async def create_many(self, data: List[Dict]) -> List[Any]:
+        result = await self.collection.insert_many(data, ordered=False)
+        return result.inserted_ids
+
     async def update(self, id: Any, data: Dict) -> bool:
         result = await self.collection.update_one({'_id': id}, {'$set': data})
         return result.modified_count > 0
@@ -64,16 +81,67 @@ class RefreshTokenRepository:
         await self.collection.insert_one(data)
 
     async def get_by_token(self, refresh_token: str):
-        return await self.collection.find_one({"refresh_token": refresh_token})
+        return await self.collection.find_one({"refresh_token": refresh_token}, projection={"user_id": 1, "_id": 0})
 
     async def delete(self, refresh_token: str):
         await self.collection.delete_one({"refresh_token": refresh_token})
 
+    async def delete_by_user(self, user_id: str) -> int:
+        result = await self.collection.delete_many({"user_id": user_id})
+        return result.deleted_count
+
     async def delete_expired(self, cutoff_time: float) -> int:
-        """Delete expired refresh tokens based on expires_at timestamp."""
-        result = await self.collection.delete_many({"expires_at": {"$lt": cutoff_time}})
+        """Delete expired refresh tokens based on expires_at timestamp (normally already purged by the TTL index)."""
+        cutoff = datetime.fromtimestamp(cutoff_time, timezone.utc)
+        result = await self.collection.delete_many({"expires_at": {"$lt": cutoff}})
         return result.deleted_count
 
+class RedisRefreshTokenRepository:
+    """
+    Refresh tokens in Redis: rt:<token hash> -> user_id with the token's TTL, plus a
+    user_rt:<user_id> set of hashes so all of a user's tokens can be revoked at once.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _token_hash(refresh_token: str) -> str:
+        return hashlib.blake2b(refresh_token.encode(), digest_size=16).hexdigest()
+
+    async def create(self, data: dict):
+        token_hash = self._token_hash(data["refresh_token"])
+        ttl = max(int(data["expires_at"].timestamp() - time.time()), 1)
+        user_key = f"user_rt:{data['user_id']}"
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(f"rt:{token_hash}", data["user_id"], ex=ttl)
+            pipe.sadd(user_key, token_hash)
+            pipe.expire(user_key, ttl)
+            await pipe.execute()
+
+    async def get_by_token(self, refresh_token: str):
+        user_id = await self.client.get(f"rt:{self._token_hash(refresh_token)}")
+        if user_id is None:
+            return None
+        return {"refresh_token": refresh_token, "user_id": user_id}
+
+    async def delete(self, refresh_token: str):
+        await self.client.delete(f"rt:{self._token_hash(refresh_token)}")
+
+    async def delete_by_user(self, user_id: str) -> int:
+        user_key = f"user_rt:{user_id}"
+        token_hashes = await self.client.smembers(user_key)
+        if not token_hashes:
+            return 0
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(*(f"rt:{token_hash}" for token_hash in token_hashes))
+            pipe.delete(user_key)
+            deleted_count, _ = await pipe.execute()
+        return deleted_count
+
+    async def delete_expired(self, cutoff_time: float) -> int:
+        """Expired tokens are removed by their Redis TTL."""
+        return 0
+
 class RateLimitRepository:
     def __init__(self, collection: AsyncIOMotorCollection):
         self.collection = collection
@@ -92,12 +160,47 @@ class RateLimitRepository:
         result = await self.collection.update_one({"key": key}, {"$set": data})
         return result.modified_count > 0
     
+    async def record_request(self, key: str, now: float, window_start: float, max_requests: int) -> Dict:
+        """
+        Atomically drop timestamps outside the window and append `now` if the
+        key is still under the limit. Returns the updated record; its
+        `last_allowed` field tells whether this request was accepted.
+        """
+        return await self.collection.find_one_and_update(
+            {"key": key},
+            [
+                {"$set": {
+                    "key": key,
+                    "timestamps": {"$filter": {
+                        "input": {"$ifNull": ["$timestamps", []]},
+                        "as": "ts",
+                        "cond": {"$gt": ["$$ts", window_start]}
+                    }}
+                }},
+                {"$set": {
+                    "last_allowed": {"$lt": [{"$size": "$timestamps"}, max_requests]}
+                }},
+                {"$set": {
+                    "timestamps": {"$cond": [
+                        "$last_allowed",
+                        {"$concatArrays": ["$timestamps", [now]]},
+                        "$timestamps"
+                    ]},
+                    "last_updated": now
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    
     async def delete_expired(self, cutoff_time: float) -> int:
         """Delete expired rate limit records."""
         result = await self.collection.delete_many({"last_updated": {"$lt": cutoff_time}})
         return result.deleted_count
 
 def get_refresh_token_repository():
+    if settings.REDIS_URL:
+        return RedisRefreshTokenRepository(get_redis())
     collection = get_collection("refresh_tokens")
     return RefreshTokenRepository(collection)
 
@@ -9,15 +9,17 @@ from contextlib import asynccontextmanager
 import asyncio
 
 from app.core.config import settings
-from app.core.logging import get_logger
-from app.core.middlewares import ErrorHandlingMiddleware, RateLimitMiddleware, CustomCORSMiddleware
+from app.core.logging import get_logger, stop_logging
+from app.core.middlewares import ErrorHandlingMiddleware, RateLimitMiddleware, CustomCORSMiddleware, UploadSizeLimitMiddleware
 from app.core.exceptions import AppBaseException
 from app.api.routes import router as api_router
-from app.auth.router import router as auth_router
+from app.auth.router import router as auth_router, init_firebase, firebase_executor
 from app.api.socketio import socket_manager  # Import Socket.IO manager
 from app.services.database import connect_to_mongodb, close_mongodb_connection
+from app.services.redis_client import close_redis_connection
 from app.core.metrics import MetricsMiddleware, metrics_endpoint
 from app.services.database import get_database
+from app.services.storage import detection_save_writer
 from firebase_admin import auth
 from app.core.rate_limit import get_rate_limiter
 from app.infrastructure.database.repository import get_refresh_token_repository
@@ -34,6 +36,7 @@ async def lifespan(app: FastAPI):
     # Start background tasks for cleanup
     cleanup_task = None
     refresh_token_cleanup_task = None
+    detection_save_task = None
     
     async def cleanup_rate_limits():
         while True:
@@ -59,6 +62,9 @@ async def lifespan(app: FastAPI):
             await asyncio.sleep(24 * 60 * 60)  # 24 hours
     
     try:
+        # Reads and parses the service-account credentials, so keep it off the event loop
+        await asyncio.to_thread(init_firebase)
+        
         logger.info("Starting up MongoDB connection")
         await connect_to_mongodb()
         
@@ -66,11 +72,23 @@ async def lifespan(app: FastAPI):
         cleanup_task = asyncio.create_task(cleanup_rate_limits())
         refresh_token_cleanup_task = asyncio.create_task(cleanup_refresh_tokens())
         logger.info("Rate limit and refresh token cleanup tasks started")
+
+        detection_save_task = asyncio.create_task(detection_save_writer())
+        logger.info("Detection save writer started")
         
         yield
     finally:
+        # Flush queued detection saves while the MongoDB connection is still open
+        if detection_save_task:
+            detection_save_task.cancel()
+            try:
+                await detection_save_task
+            except asyncio.CancelledError:
+                logger.info("Detection save writer stopped")
+
         logger.info("Shutting down MongoDB connection")
         await close_mongodb_connection()
+        await close_redis_connection()
         
         # Cancel background tasks
         if cleanup_task:
@@ -87,6 +105,9 @@ async def lifespan(app: FastAPI):
             except asyncio.CancelledError:
                 logger.info("Refresh token cleanup task cancelled")
 
+        # Drain queued file-log records last so shutdown messages are written
+        stop_logging()
+
 
 def custom_openapi():
     if app.openapi_schema:
@@ -127,6 +148,9 @@ app.add_middleware(
     window_seconds= settings.GUEST_WINDOW_SECONDS
 )
 
+# Reject oversized uploads before they are read (and before they count against the rate limit)
+app.add_middleware(UploadSizeLimitMiddleware, max_image_bytes=settings.MAX_IMAGE_BYTES, max_batch_size=settings.MAX_BATCH_SIZE)
+
 # Add CustomCORSMiddleware to ensure proper CORS headers for all responses
 app.add_middleware(CustomCORSMiddleware)
 
@@ -179,8 +203,10 @@ async def readyz():
         mongo_status = "not ready"
 
     try:
-        # Check Firebase connection 
-        auth.get_user_by_email("tester@email.com")
+        # Check Firebase connection (blocking Admin SDK call, run off the event loop)
+        await asyncio.get_running_loop().run_in_executor(
+            firebase_executor, auth.get_user_by_email, "tester@email.com"
+        )
         firebase_status = "ready"
     except Exception as e:
         logger.error(f"Firebase health check failed: {str(e)}")
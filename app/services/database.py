@@ -17,14 +17,36 @@ async def connect_to_mongodb():
         if mongo_client is not None:
             return
 
-        # Create MongoDB connection
-        mongo_client = AsyncIOMotorClient(settings.MONGODB_URI)
+        # Create MongoDB connection with a pool shared by all requests
+        mongo_client = AsyncIOMotorClient(
+            settings.MONGODB_URI,
+            minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+            maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+            maxIdleTimeMS=settings.MONGODB_MAX_IDLE_TIME_MS,
+            waitQueueTimeoutMS=settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        )
         database = mongo_client[settings.MONGODB_NAME]
+        # Warm up the pool so the first requests don't pay the TCP/TLS handshake
+        await database.command("ping")
         logging.info("Connected to MongoDB Atlas")
+        await ensure_indexes()
     except Exception as e:
         logging.error(f"Failed to connect to MongoDB: {e}")
         raise
 
+async def ensure_indexes():
+    """
+    Create the indexes the repositories' queries rely on (no-op when they already exist).
+    """
+    try:
+        refresh_tokens = database["refresh_tokens"]
+        await refresh_tokens.create_index("refresh_token", unique=True)
+        await refresh_tokens.create_index([("user_id", 1), ("expires_at", 1)])
+        # MongoDB removes each token once its expires_at has passed
+        await refresh_tokens.create_index("expires_at", expireAfterSeconds=0)
+    except Exception as e:
+        logging.warning(f"Could not create MongoDB indexes: {e}")
+
 async def close_mongodb_connection():
     """
     Close MongoDB connection.
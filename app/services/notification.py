@@ -1,8 +1,12 @@
-from typing import Dict
+import asyncio
+from typing import Callable, Dict, List
 from datetime import datetime, timedelta
 
 notification_store: Dict[str, tuple] = {}
 
+# Coroutines waiting for a detection to leave the "pending" state
+notification_waiters: Dict[str, List[asyncio.Future]] = {}
+
 def cleanup_old_notifications():
     """Remove notifications older than 5 minutes"""
     current_time = datetime.now()
@@ -11,17 +15,56 @@ def cleanup_old_notifications():
         if current_time - timestamp > timedelta(minutes=5)
     ]
     for detection_id in expired_ids:
-        notification_store.pop(detection_id, None)
+        status, _ = notification_store.pop(detection_id)
+        # A detection stuck in "pending" never resolves its waiters; release them as still pending
+        for waiter in notification_waiters.pop(detection_id, []):
+            if not waiter.done():
+                waiter.set_result(status)
 
 def set_notification(detection_id: str, status: str):
     cleanup_old_notifications()
     notification_store[detection_id] = (status, datetime.now())
+    if status != "pending":
+        for waiter in notification_waiters.pop(detection_id, []):
+            if not waiter.done():
+                waiter.set_result(status)
 
 def get_notification(detection_id: str) -> str:
     cleanup_old_notifications()
     notification_data = notification_store.get(detection_id)
     return notification_data[0] if notification_data else "done"
 
+async def wait_for_notification(detection_id: str, timeout: float = 30) -> str:
+    """Wait until a pending detection is done/failed (or timeout) and return its status."""
+    status = get_notification(detection_id)
+    if status != "pending":
+        return status
+    waiter = asyncio.get_running_loop().create_future()
+    notification_waiters.setdefault(detection_id, []).append(waiter)
+    try:
+        return await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        return get_notification(detection_id)
+    finally:
+        waiters = notification_waiters.get(detection_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                notification_waiters.pop(detection_id, None)
+
+def on_notification(detection_id: str, callback: Callable[[str], None]) -> None:
+    """Call callback(status) once the detection leaves "pending" (right away if it already has)."""
+    status = get_notification(detection_id)
+    if status != "pending":
+        callback(status)
+        return
+    waiter = asyncio.get_running_loop().create_future()
+    waiter.add_done_callback(lambda done: callback(done.result()))
+    notification_waiters.setdefault(detection_id, []).append(waiter)
+
+def notify_processing_pending(detection_id: str):
+    set_notification(detection_id, "pending")
+
 def notify_processing_done(detection_id: str):
     set_notification(detection_id, "done")
 
@@ -0,0 +1,28 @@
+import redis.asyncio as redis
+from typing import Optional
+from app.core.config import settings
+import logging
+
+# Initialize Redis client (only when REDIS_URL is configured)
+redis_client: Optional[redis.Redis] = None
+
+def get_redis() -> redis.Redis:
+    """
+    Get the shared Redis client, created on first use. The pool connects lazily.
+    """
+    global redis_client
+    if not settings.REDIS_URL:
+        raise ValueError("REDIS_URL is not configured")
+    if redis_client is None:
+        redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return redis_client
+
+async def close_redis_connection():
+    """
+    Close Redis connection.
+    """
+    global redis_client
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+        logging.info("Closed Redis connection")
@@ -3,8 +3,22 @@ from datetime import datetime
 from app.domain.models.detection import DetectionResponse
 from app.infrastructure.database.repository import DetectionRepository
 from app.services.database import get_collection
+from app.services.notification import notify_processing_done, notify_processing_failed
+from app.core.config import settings
+from app.core.logging import get_logger
+import asyncio
 import json
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from cachetools import TTLCache
+
+logger = get_logger("storage")
+
+# Short-lived cache for detail lookups (detail page is usually followed by another action)
+detection_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+# Background saves are buffered here and written in bulk by detection_save_writer
+detection_save_queue: "asyncio.Queue[DetectionResponse]" = asyncio.Queue()
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -64,15 +78,91 @@ async def save_detection(detection: DetectionResponse) -> str:
         print(f"Error saving detection to MongoDB: {e}")
     return detection.detection_id
 
-async def get_detection(detection_id: str) -> Optional[DetectionResponse]:
+def enqueue_detection_save(detection: DetectionResponse) -> None:
+    """
+    Queue a detection for the bulk writer; its status becomes done/failed once written.
+    """
+    detection_save_queue.put_nowait(detection)
+
+async def flush_detection_saves(detections: List[DetectionResponse]) -> None:
+    """
+    Write a batch of detections with a single insert_many and notify their status.
+    """
+    failed_indexes = set()
+    try:
+        repo = DetectionRepository(get_collection("detections"))
+        documents = []
+        for detection in detections:
+            detection_dict = detection_to_dict(detection)
+            detection_dict["_id"] = detection_dict.pop("detection_id")
+            documents.append(detection_dict)
+        await repo.create_many(documents)
+    except BulkWriteError as e:
+        # Unordered insert: only the documents listed in writeErrors were not stored
+        failed_indexes = {error["index"] for error in e.details.get("writeErrors", [])}
+        logger.exception(f"Failed to save {len(failed_indexes)} of {len(detections)} detections to MongoDB")
+    except Exception:
+        logger.exception(f"Error saving {len(detections)} detections to MongoDB")
+        failed_indexes = set(range(len(detections)))
+    for index, detection in enumerate(detections):
+        if index in failed_indexes:
+            notify_processing_failed(detection.detection_id)
+        else:
+            notify_processing_done(detection.detection_id)
+
+def _drain_save_queue(batch: List[DetectionResponse]) -> None:
+    while len(batch) < settings.DETECTION_SAVE_BATCH_SIZE and not detection_save_queue.empty():
+        batch.append(detection_save_queue.get_nowait())
+
+async def detection_save_writer() -> None:
+    """
+    Single consumer of detection_save_queue: waits for one save, lets others pile up
+    for DETECTION_SAVE_FLUSH_MS, then writes up to DETECTION_SAVE_BATCH_SIZE at once.
+    Pending saves are flushed when the task is cancelled.
+    """
+    batch: List[DetectionResponse] = []
+    try:
+        while True:
+            batch.append(await detection_save_queue.get())
+            if detection_save_queue.qsize() + 1 < settings.DETECTION_SAVE_BATCH_SIZE:
+                await asyncio.sleep(settings.DETECTION_SAVE_FLUSH_MS / 1000)
+            _drain_save_queue(batch)
+            pending, batch = batch, []
+            flush = asyncio.ensure_future(flush_detection_saves(pending))
+            try:
+                await asyncio.shield(flush)
+            except asyncio.CancelledError:
+                # The batch is already off the queue: finish writing it before shutting down
+                await flush
+                raise
+    except asyncio.CancelledError:
+        _drain_save_queue(batch)
+        while batch:
+            pending, batch = batch, []
+            await flush_detection_saves(pending)
+            _drain_save_queue(batch)
+        raise
+
+async def get_detection(detection_id: str, user_id: Optional[str] = None) -> Optional[DetectionResponse]:
     """
     Get a detection by ID using DetectionRepository.
+    If user_id is given, only a detection owned by that user is returned.
     """
+    cached = detection_cache.get(detection_id)
+    if cached is not None:
+        if user_id is not None and cached.user_id != user_id:
+            return None
+        return cached
     try:
         repo = DetectionRepository(get_collection("detections"))
-        detection_dict = await repo.get_by_id(detection_id)
+        if user_id is not None:
+            detection_dict = await repo.get_by_id_for_user(detection_id, user_id)
+        else:
+            detection_dict = await repo.get_by_id(detection_id)
         if detection_dict:
-            return dict_to_detection(detection_dict)
+            detection = dict_to_detection(detection_dict)
+            detection_cache[detection_id] = detection
+            return detection
     except Exception as e:
         print(f"Error retrieving detection from MongoDB: {e}")
     return None
@@ -92,13 +182,17 @@ async def get_detections_by_user(user_id: str, skip: int = 0, limit: int = 10) -
         print(f"Error retrieving detections from MongoDB: {e}")
     return detections
 
-async def delete_detection(detection_id: str) -> bool:
+async def delete_detection(detection_id: str, user_id: Optional[str] = None) -> bool:
     """
     Delete a detection by ID using DetectionRepository.
+    If user_id is given, only a detection owned by that user is deleted.
     """
+    detection_cache.pop(detection_id, None)
     try:
         repo = DetectionRepository(get_collection("detections"))
+        if user_id is not None:
+            return await repo.delete_for_user(detection_id, user_id)
         return await repo.delete(detection_id)
     except Exception as e:
         print(f"Error deleting detection from MongoDB: {e}")
-    return False
\ No newline at end of file
+    return False
@@ -3,15 +3,17 @@ import cv2
 import numpy as np
 import base64
 import torch
-from typing import Dict, Optional, Any
+import asyncio
+import concurrent.futures
+from typing import Dict, Optional, Any, List, Tuple, Union
 from collections import deque
-import os
 
 from app.services.face_detection import detect_faces, crop_faces
 from app.services.preprocessing import preprocess_face
 from app.services.model_loader import EmotionModelCache
-from app.domain.models.detection import DetectionResult, EmotionScore, FaceDetection
+from app.domain.models.detection import EmotionScore, FaceDetection
 from app.core.metrics import realtime_fps_gauge
+from app.core.config import settings
 
 DEFAULT_VIDEO_CONFIG = {
     "detection_interval": 1,
@@ -22,6 +24,99 @@ DEFAULT_VIDEO_CONFIG = {
     "return_bounding_boxes": True,
     "prioritize_realtime": True
 }
+
+def classify_faces(faces: List[Any]) -> torch.Tensor:
+    """
+    Run one forward pass over preprocessed faces and return softmax probabilities (one row per face).
+    """
+    image_processor, model = EmotionModelCache.get_model_and_processor()
+    inputs = image_processor(images=faces, return_tensors="pt")
+    with torch.no_grad():
+        outputs = model(**inputs)
+        return torch.nn.functional.softmax(outputs.logits, dim=-1)
+
+class FaceBatcher:
+    """
+    Micro-batches face classification across realtime clients: requests arriving
+    within REALTIME_BATCH_WAIT_MS share one forward pass on a single inference thread.
+    """
+    def __init__(self, max_wait: float, max_faces: int):
+        self.max_wait = max_wait
+        self.max_faces = max_faces
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="realtime-inference")
+
+    async def classify(self, faces: List[Any]) -> torch.Tensor:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((faces, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending: List[Tuple[List[Any], asyncio.Future]] = [await self._queue.get()]
+            face_count = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while face_count < self.max_faces:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                face_count += len(item[0])
+
+            all_faces = [face for faces, _ in pending for face in faces]
+            try:
+                probabilities = await loop.run_in_executor(self._executor, classify_faces, all_faces)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            offset = 0
+            for faces, future in pending:
+                if not future.done():
+                    future.set_result(probabilities[offset:offset + len(faces)])
+                offset += len(faces)
+
+# Face detection/preprocessing for realtime frames. Kept smaller than the connection cap so
+# the detector does not oversubscribe the CPU; extra frames wait in the executor queue.
+face_detect_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.REALTIME_DETECT_WORKERS,
+    thread_name_prefix="realtime-detect"
+)
+
+face_batcher = FaceBatcher(
+    max_wait=settings.REALTIME_BATCH_WAIT_MS / 1000,
+    max_faces=settings.REALTIME_BATCH_MAX_FACES
+)
+
+def decode_frame(payload: Union[bytes, bytearray, str], reduced: bool = False) -> np.ndarray:
+    """
+    Decode a JPEG/PNG payload (raw bytes, or base64 text from legacy clients) into a BGR frame.
+    With reduced=True the image is decoded at half size (libjpeg scales during decode).
+    CPU-bound: run it in an executor.
+    """
+    try:
+        img_bytes = base64.b64decode(payload) if isinstance(payload, str) else payload
+        nparr = np.frombuffer(img_bytes, np.uint8)
+        frame = cv2.imdecode(nparr, cv2.IMREAD_REDUCED_COLOR_2 if reduced else cv2.IMREAD_COLOR)
+        
+        if frame is None:
+            raise ValueError("Invalid frame data after decoding")
+            
+    except Exception as e:
+        raise ValueError(f"Failed to decode frame: {str(e)}")
+    return frame
+
 class VideoEmotionDetector:
 
     def __init__(self, config: Optional[Dict[str, Any]] = None):
@@ -36,37 +131,35 @@ class VideoEmotionDetector:
         
         self.face_ids = {}
         self.next_face_id = 0
+        # Full-resolution (width, height) of the last frame the client sent
+        self.input_size: Optional[Tuple[int, int]] = None
         
-    async def process_frame(self, frame_data: Dict[str, Any]) -> Dict[str, Any]:
-        start_time = time.time()
+    def _processing_size(self) -> Tuple[int, int]:
+        processing_width, processing_height = self.config["processing_resolution"]
+        return max(processing_width, 320), max(processing_height, 240)
         
-        frame_id = frame_data.get("frame_id")
-        timestamp = frame_data.get("timestamp", time.time())
-        base64_data = frame_data.get("data")
+    def decode_reduced(self) -> bool:
+        """
+        True when the client's frames are at least twice the processing resolution, so the next
+        frame can be decoded at half size without losing detail the detector would use.
+        """
+        if self.input_size is None:
+            return False
+        processing_width, processing_height = self._processing_size()
+        input_width, input_height = self.input_size
+        return min(processing_width / input_width, processing_height / input_height) <= 0.5
         
+    def _prepare_faces(self, frame: np.ndarray, input_scale: float = 1.0) -> Tuple[List[Tuple[int, int, int, int]], List[str], List[Any]]:
+        """
+        Resize, detect, track and preprocess faces in a frame. Blocking (OpenCV + numpy),
+        so process_frame runs it on face_detect_executor.
+        input_scale is the client frame size over the decoded frame size (2.0 for a reduced decode).
+        Returns (boxes in client frame coordinates, face ids, preprocessed faces).
+        """
         try:
-            if "," in base64_data:
-                base64_data = base64_data.split(",", 1)[1]
-
-            img_bytes = base64.b64decode(base64_data)
-            nparr = np.frombuffer(img_bytes, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if frame is None:
-                raise ValueError("Invalid frame data after decoding")
-                
-        except Exception as e:
-            raise ValueError(f"Failed to decode frame: {str(e)}")
-            
-        try:
-            processing_width, processing_height = self.config["processing_resolution"]
+            processing_width, processing_height = self._processing_size()
             original_height, original_width = frame.shape[:2]
             
-            if processing_width < 320:
-                processing_width = 320
-            if processing_height < 240:
-                processing_height = 240
-                
             scale_factor = min(processing_width / original_width, 
                               processing_height / original_height)
             
@@ -82,8 +175,7 @@ class VideoEmotionDetector:
         except Exception as e:
             processing_frame = frame
             resize_scale = 1.0
-        
-        self.frame_count += 1
+        resize_scale *= input_scale
         
         face_boxes = []
         face_ids = []
@@ -154,24 +246,42 @@ class VideoEmotionDetector:
             face_ids = []
             original_boxes = []
         
-        face_detected = len(face_boxes) > 0
+        if len(face_boxes) == 0:
+            return original_boxes, face_ids, []
+        
+        try:
+            faces = crop_faces(processing_frame, face_boxes)
+            return original_boxes, face_ids, [preprocess_face(face) for face in faces]
+        except Exception as e:
+            return original_boxes, face_ids, []
+        
+    async def process_frame(self, frame: np.ndarray, frame_id: Any = None, timestamp: Optional[float] = None,
+                            input_scale: float = 1.0) -> Dict[str, Any]:
+        start_time = time.time()
+        if timestamp is None:
+            timestamp = start_time
+        
+        self.frame_count += 1
+        frame_height, frame_width = frame.shape[:2]
+        self.input_size = (int(frame_width * input_scale), int(frame_height * input_scale))
+        
+        # Calls for one client are sequential (one consumer task each), so tracking state
+        # is never touched by two threads at once
+        loop = asyncio.get_running_loop()
+        original_boxes, face_ids, preprocessed_faces = await loop.run_in_executor(
+            face_detect_executor, self._prepare_faces, frame, input_scale
+        )
+        
+        face_detected = len(original_boxes) > 0
         face_detections = []
         
         if face_detected:
             try:
-                image_processor, model = EmotionModelCache.get_model_and_processor()
-                
-                faces = crop_faces(processing_frame, face_boxes)
-                
-                preprocessed_faces = [preprocess_face(face) for face in faces]
+                _, model = EmotionModelCache.get_model_and_processor()
                 
                 if preprocessed_faces:
-                    inputs = image_processor(images=preprocessed_faces, return_tensors="pt")
-                    
-                    with torch.no_grad():
-                        outputs = model(**inputs)
-                        logits = outputs.logits
-                        probabilities = torch.nn.functional.softmax(logits, dim=-1)
+                    # Shared with other clients' frames arriving in the same window
+                    probabilities = await face_batcher.classify(preprocessed_faces)
                     
                     # Lấy labels từ model config
                     if hasattr(model.config, "id2label"):
@@ -203,7 +313,9 @@ class VideoEmotionDetector:
             except Exception as e:
                 face_detected = len(face_detections) > 0
         
-        processing_time = time.time() - start_time
+        # One clock read for every timestamp derived from the end of processing
+        end_time = time.time()
+        processing_time = end_time - start_time
         self.processing_times.append(processing_time)
         
         if len(self.processing_times) > 0:
@@ -212,13 +324,13 @@ class VideoEmotionDetector:
             realtime_fps_gauge.set(self.processing_fps)
         
         if face_detected:
-            self.last_detection_time = time.time()
+            self.last_detection_time = end_time
         
-        latency = time.time() - timestamp if timestamp else processing_time
+        latency = end_time - timestamp if timestamp else processing_time
         
         result = {
             "frame_id": frame_id,
-            "timestamp": time.time(),
+            "timestamp": end_time,
             "processing_time": processing_time,
             "latency": latency,
             "fps": self.processing_fps,
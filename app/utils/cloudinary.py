@@ -4,6 +4,7 @@ from app.core.config import settings
 import uuid
 from PIL import Image
 import io
+import asyncio
 
 cloudinary.config(
     cloud_name=settings.CLOUDINARY_CLOUD_NAME,
@@ -28,10 +29,7 @@ def preprocess_image_for_upload(image_data: bytes, max_size: int = 800) -> bytes
         print(f"Error preprocessing image for Cloudinary: {e}")
         return image_data
 
-async def upload_image_to_cloudinary(image_data: bytes) -> str:
-    """
-    Upload an image to Cloudinary and return the URL.
-    """
+def _upload_image_sync(image_data: bytes) -> str:
     processed_data = preprocess_image_for_upload(image_data)
     public_id = f"emotion_detection/{uuid.uuid4()}"
     try:
@@ -45,3 +43,10 @@ async def upload_image_to_cloudinary(image_data: bytes) -> str:
     except Exception as e:
         print(f"Error uploading to Cloudinary: {e}")
         return ""
+
+async def upload_image_to_cloudinary(image_data: bytes) -> str:
+    """
+    Upload an image to Cloudinary and return the URL.
+    Resize/encode and the blocking HTTP upload run in a worker thread.
+    """
+    return await asyncio.to_thread(_upload_image_sync, image_data)
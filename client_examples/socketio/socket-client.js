@@ -9,6 +9,12 @@ let frameRate = 3 // FPS
 let isCameraRunning = false
 let isProcessing = false
 
+// Frame encoding: giới hạn độ phân giải theo server và nén JPEG 80%
+const JPEG_QUALITY = 0.8
+let maxResolution = [640, 480]
+let frameCanvas = null
+let frameScale = 1 // tỉ lệ từ frame gửi đi về kích thước video gốc
+
 // Theo dõi các face boxes
 let currentFaces = {}
 let lastUpdateTime = 0
@@ -150,6 +156,10 @@ function setupSocketEvents() {
       frameRate = Math.min(frameRate, data.config.max_frame_rate)
       logEvent("info", `Using frame rate: ${frameRate} FPS`)
     }
+
+    if (data.config && data.config.max_resolution) {
+      maxResolution = data.config.max_resolution
+    }
   })
 
   socket.on("detection_result", (data) => {
@@ -301,23 +311,45 @@ function stopFrameProcessing() {
 }
 
 // Send a single video frame to the server
-function sendVideoFrame() {
+async function sendVideoFrame() {
   try {
-    // Tạo canvas ẩn để convert video frame thành base64
-    const tempCanvas = document.createElement("canvas")
-    tempCanvas.width = videoElement.videoWidth
-    tempCanvas.height = videoElement.videoHeight
+    // Canvas ẩn (dùng lại giữa các frame) để encode video frame thành JPEG,
+    // thu nhỏ nếu video lớn hơn max_resolution của server
+    if (!frameCanvas) {
+      frameCanvas = document.createElement("canvas")
+    }
+    const scale = Math.min(
+      1,
+      maxResolution[0] / videoElement.videoWidth,
+      maxResolution[1] / videoElement.videoHeight
+    )
+    const width = Math.round(videoElement.videoWidth * scale)
+    const height = Math.round(videoElement.videoHeight * scale)
+    if (frameCanvas.width !== width || frameCanvas.height !== height) {
+      frameCanvas.width = width
+      frameCanvas.height = height
+    }
+    frameScale = 1 / scale
+    const tempCanvas = frameCanvas
     const tempCtx = tempCanvas.getContext("2d")
     tempCtx.drawImage(videoElement, 0, 0, tempCanvas.width, tempCanvas.height)
 
-    // Convert canvas to JPEG base64
-    const imageData = tempCanvas.toDataURL("image/jpeg", 0.8).split(",")[1]
+    const frameId = frameCounter++
+    const timestamp = Date.now() / 1000
+    const resolution = [tempCanvas.width, tempCanvas.height]
+
+    // Encode canvas to JPEG bytes (gửi dạng binary, không cần base64)
+    const blob = await new Promise((resolve) =>
+      tempCanvas.toBlob(resolve, "image/jpeg", JPEG_QUALITY)
+    )
+    if (!blob || !socket) return
+    const imageData = await blob.arrayBuffer()
 
     // Send frame to server
     socket.emit("video_frame", {
-      frame_id: frameCounter++,
-      timestamp: Date.now() / 1000,
-      resolution: [tempCanvas.width, tempCanvas.height],
+      frame_id: frameId,
+      timestamp: timestamp,
+      resolution: resolution,
       data: imageData,
     })
   } catch (error) {
@@ -378,20 +410,22 @@ function updateFaceBoxes(faces) {
   // Cập nhật hoặc thêm mới faces
   faces.forEach((face) => {
     const faceId = face.face_id
+    // Box trả về theo kích thước frame đã gửi, quy đổi về kích thước video
+    const box = face.box ? face.box.map((v) => v * frameScale) : face.box
     currentIds.add(faceId)
 
     // Kiểm tra nếu face đã tồn tại
     if (currentFaces[faceId]) {
       // Face đã tồn tại - lưu vị trí cũ để tạo animation
       const oldFace = currentFaces[faceId]
-      oldFace.targetBox = face.box
+      oldFace.targetBox = box
       oldFace.lastUpdate = currentTime
       oldFace.emotions = face.emotions
     } else {
       // Face mới - thêm vào map với animation bắt đầu
       currentFaces[faceId] = {
-        box: face.box, // Hộp hiện tại
-        targetBox: face.box, // Hộp đích (cùng - không animation ban đầu)
+        box: box, // Hộp hiện tại
+        targetBox: box, // Hộp đích (cùng - không animation ban đầu)
         emotions: face.emotions,
         lastUpdate: currentTime,
         opacity: 1, // Bắt đầu mờ và sẽ fade in
@@ -0,0 +1,144 @@
+import sys
+import os
+import time
+import uuid
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("SECRET_KEY", "unit-test-secret-key-0123456789abcdef")
+
+import jwt
+import pytest
+
+from app.auth import auth_utils
+from app.auth.auth_utils import (
+    GUEST_ID_PREFIX,
+    decode_guest_cookie,
+    encode_guest_cookie,
+    read_guest_cookie,
+    verify_token,
+)
+from app.core.config import settings
+from app.core.exceptions import AuthenticationException
+
+
+def make_guest_id():
+    return f"{GUEST_ID_PREFIX}{uuid.uuid4()}"
+
+
+# --- Guest cookie (chunk2-13) ---
+
+def test_guest_cookie_round_trip():
+    guest_id = make_guest_id()
+    cookie = encode_guest_cookie(guest_id)
+    guest = read_guest_cookie(cookie, max_age=60)
+    assert guest is not None
+    assert guest[0] == guest_id
+    assert abs(guest[1] - time.time()) < 5
+    assert decode_guest_cookie(cookie, max_age=60) == guest_id
+
+
+def test_guest_cookie_rejects_tampered_body_and_tag():
+    cookie = encode_guest_cookie(make_guest_id())
+    body, tag = cookie.split(".")
+    # Đổi một ký tự của body (id khác) -> chữ ký không còn khớp
+    flipped_body = ("A" if body[0] != "A" else "B") + body[1:]
+    assert read_guest_cookie(f"{flipped_body}.{tag}", max_age=60) is None
+    flipped_tag = ("A" if tag[0] != "A" else "B") + tag[1:]
+    assert read_guest_cookie(f"{body}.{flipped_tag}", max_age=60) is None
+
+
+def test_guest_cookie_rejects_other_secret(monkeypatch):
+    cookie = encode_guest_cookie(make_guest_id())
+    monkeypatch.setattr(auth_utils, "_SECRET_KEY", b"another-secret-key-0123456789abcdef")
+    assert read_guest_cookie(cookie, max_age=60) is None
+
+
+def test_guest_cookie_expires(monkeypatch):
+    cookie = encode_guest_cookie(make_guest_id())
+    now = time.time()
+    monkeypatch.setattr(auth_utils.time, "time", lambda: now + 120)
+    assert read_guest_cookie(cookie, max_age=60) is None
+    assert read_guest_cookie(cookie, max_age=300) is not None
+
+
+@pytest.mark.parametrize("cookie", [
+    "",
+    "not-a-cookie",
+    "a.b.c",
+    '{"guest_id": "guest_123", "usage_count": 0}',  # cookie JSON cũ (chưa ký)
+])
+def test_guest_cookie_rejects_malformed(cookie):
+    assert read_guest_cookie(cookie, max_age=60) is None
+    assert decode_guest_cookie(cookie, max_age=60) is None
+
+
+# --- verify_token (chunk2-5, chunk2-14) ---
+
+@pytest.fixture(autouse=True)
+def clear_verified_tokens():
+    auth_utils._verified_tokens.clear()
+    yield
+    auth_utils._verified_tokens.clear()
+
+
+def make_token(claims):
+    return jwt.encode(claims, settings.SECRET_KEY.encode(), algorithm=settings.ALGORITHM)
+
+
+def test_verify_token_returns_payload_and_caches_it(monkeypatch):
+    token = make_token({"sub": "user-1", "exp": int(time.time()) + 600})
+    payload = verify_token(token)
+    assert payload["sub"] == "user-1"
+
+    # Lần gọi thứ hai lấy từ cache, không decode lại
+    def fail_decode(*args, **kwargs):
+        raise AssertionError("token decoded again")
+    monkeypatch.setattr(auth_utils.jwt, "decode", fail_decode)
+    assert verify_token(token) is payload
+
+
+def test_verify_token_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(auth_utils, "VERIFIED_TOKEN_CACHE_SIZE", 2)
+    exp = int(time.time()) + 600
+    tokens = [make_token({"sub": f"user-{i}", "exp": exp}) for i in range(3)]
+    for token in tokens:
+        verify_token(token)
+    assert len(auth_utils._verified_tokens) == 2
+
+
+def test_verify_token_drops_entries_close_to_expiry(monkeypatch):
+    now = time.time()
+    token = make_token({"sub": "user-1", "exp": int(now) + 600})
+    verify_token(token)
+
+    decode_calls = []
+    real_decode = auth_utils.jwt.decode
+    def counting_decode(*args, **kwargs):
+        decode_calls.append(args)
+        return real_decode(*args, **kwargs)
+    monkeypatch.setattr(auth_utils.jwt, "decode", counting_decode)
+
+    # Còn xa hạn -> dùng cache; trong khoảng leeway trước exp -> decode lại
+    verify_token(token)
+    assert decode_calls == []
+    monkeypatch.setattr(auth_utils.time, "time", lambda: now + 600 - auth_utils.VERIFIED_TOKEN_EXP_LEEWAY)
+    verify_token(token)
+    assert len(decode_calls) == 1
+
+
+@pytest.mark.parametrize("claims", [
+    {"sub": "user-1"},                        # thiếu exp
+    {"exp": int(time.time()) + 600},          # thiếu sub
+])
+def test_verify_token_requires_exp_and_sub(claims):
+    with pytest.raises(AuthenticationException):
+        verify_token(make_token(claims))
+
+
+def test_verify_token_rejects_expired_and_bad_signature():
+    expired = make_token({"sub": "user-1", "exp": int(time.time()) - 10})
+    with pytest.raises(AuthenticationException, match="Token expired"):
+        verify_token(expired)
+
+    forged = jwt.encode({"sub": "user-1", "exp": int(time.time()) + 600}, b"wrong-key-0123456789abcdef0123456789", algorithm=settings.ALGORITHM)
+    with pytest.raises(AuthenticationException):
+        verify_token(forged)
@@ -0,0 +1,80 @@
+import sys
+import os
+import asyncio
+import threading
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("SECRET_KEY", "unit-test-secret-key-0123456789abcdef")
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("cv2")
+
+from app.services import video_emotion_detection
+from app.services.video_emotion_detection import FaceBatcher
+
+
+@pytest.fixture
+def forward_passes(monkeypatch):
+    """Thay model bằng hàm giả: mỗi face trả về chính nó, ghi lại từng batch."""
+    batches = []
+    lock = threading.Lock()
+
+    def fake_classify(faces):
+        with lock:
+            batches.append(list(faces))
+        if "bad" in faces:
+            raise RuntimeError("inference failed")
+        return list(faces)
+
+    monkeypatch.setattr(video_emotion_detection, "classify_faces", fake_classify)
+    return batches
+
+
+@pytest.mark.asyncio
+async def test_requests_within_wait_share_one_forward_pass(forward_passes):
+    batcher = FaceBatcher(max_wait=0.05, max_faces=32)
+    results = await asyncio.gather(
+        batcher.classify(["a1", "a2"]),
+        batcher.classify(["b1"]),
+        batcher.classify(["c1", "c2", "c3"]),
+    )
+
+    assert forward_passes == [["a1", "a2", "b1", "c1", "c2", "c3"]]
+    # Mỗi client nhận đúng phần kết quả của mình
+    assert results == [["a1", "a2"], ["b1"], ["c1", "c2", "c3"]]
+
+
+@pytest.mark.asyncio
+async def test_requests_after_wait_go_to_next_batch(forward_passes):
+    batcher = FaceBatcher(max_wait=0.01, max_faces=32)
+    first = await batcher.classify(["a1"])
+    await asyncio.sleep(0.05)
+    second = await batcher.classify(["b1"])
+
+    assert (first, second) == (["a1"], ["b1"])
+    assert forward_passes == [["a1"], ["b1"]]
+
+
+@pytest.mark.asyncio
+async def test_full_batch_does_not_wait_for_timeout(forward_passes):
+    batcher = FaceBatcher(max_wait=5, max_faces=2)
+    results = await asyncio.wait_for(
+        asyncio.gather(batcher.classify(["a1"]), batcher.classify(["b1"])),
+        timeout=1
+    )
+    assert results == [["a1"], ["b1"]]
+
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_request_in_the_batch(forward_passes):
+    batcher = FaceBatcher(max_wait=0.05, max_faces=32)
+    results = await asyncio.gather(
+        batcher.classify(["a1"]),
+        batcher.classify(["bad"]),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    # Batcher vẫn hoạt động sau lỗi
+    assert await batcher.classify(["c1"]) == ["c1"]
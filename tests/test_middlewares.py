@@ -0,0 +1,89 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("SECRET_KEY", "unit-test-secret-key-0123456789abcdef")
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from fastapi.testclient import TestClient
+
+from app.core import middlewares
+from app.core.config import settings
+from app.core.middlewares import RateLimitMiddleware, UploadSizeLimitMiddleware
+from app.auth.auth_utils import GUEST_COOKIE_NAME
+
+MAX_IMAGE_BYTES = 1024
+MAX_BATCH_SIZE = 3
+DETECT_PATH = f"{settings.API_PREFIX}/detect"
+BATCH_PATH = f"{settings.API_PREFIX}/detect/batch"
+
+
+async def ok(request):
+    return PlainTextResponse("ok")
+
+
+def make_client(middleware, **options):
+    app = Starlette(routes=[
+        Route(DETECT_PATH, ok, methods=["POST"]),
+        Route(BATCH_PATH, ok, methods=["POST"]),
+        Route("/other", ok, methods=["POST"]),
+    ])
+    app.add_middleware(middleware, **options)
+    return TestClient(app)
+
+
+@pytest.fixture
+def upload_client():
+    return make_client(UploadSizeLimitMiddleware, max_image_bytes=MAX_IMAGE_BYTES, max_batch_size=MAX_BATCH_SIZE)
+
+
+def body_of(size):
+    return b"x" * size
+
+
+# --- UploadSizeLimitMiddleware (chunk0-23) ---
+
+def test_upload_limit_rejects_large_detect_body(upload_client):
+    limit = MAX_IMAGE_BYTES + UploadSizeLimitMiddleware.FORM_OVERHEAD_BYTES
+    assert upload_client.post(DETECT_PATH, content=body_of(limit)).status_code == 200
+
+    resp = upload_client.post(DETECT_PATH, content=body_of(limit + 1))
+    assert resp.status_code == 413
+    # Cùng dạng {"detail": ...} với lỗi 413 của route
+    assert set(resp.json()) == {"detail"}
+
+
+def test_upload_limit_scales_batch_with_batch_size(upload_client):
+    limit = (MAX_IMAGE_BYTES + UploadSizeLimitMiddleware.FORM_OVERHEAD_BYTES) * MAX_BATCH_SIZE
+    assert upload_client.post(BATCH_PATH, content=body_of(limit)).status_code == 200
+
+    resp = upload_client.post(BATCH_PATH, content=body_of(limit + 1))
+    assert resp.status_code == 413
+    assert "detail" in resp.json()
+
+
+def test_upload_limit_ignores_other_paths(upload_client):
+    big = body_of((MAX_IMAGE_BYTES + UploadSizeLimitMiddleware.FORM_OVERHEAD_BYTES) * MAX_BATCH_SIZE + 1)
+    assert upload_client.post("/other", content=big).status_code == 200
+
+
+# --- RateLimitMiddleware: cookie guest không hợp lệ (chunk2-13) ---
+
+class FailingRateLimiter:
+    async def check_rate_limit(self, **kwargs):
+        raise AssertionError(f"rate limited on {kwargs['key']!r}")
+
+
+@pytest.mark.parametrize("cookie", [
+    None,
+    '{"guest_id": "guest_123", "usage_count": 0}',
+    "garbage.cookie",
+])
+def test_rate_limit_treats_invalid_guest_cookie_as_missing(monkeypatch, cookie):
+    monkeypatch.setattr(middlewares, "get_rate_limiter", lambda: FailingRateLimiter())
+    client = make_client(RateLimitMiddleware, max_requests=1, window_seconds=60)
+    if cookie is not None:
+        client.cookies.set(GUEST_COOKIE_NAME, cookie)
+    assert client.post(DETECT_PATH).status_code == 403
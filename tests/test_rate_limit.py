@@ -0,0 +1,109 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("SECRET_KEY", "unit-test-secret-key-0123456789abcdef")
+
+import pytest
+
+from app.core.rate_limit import MongoRateLimiter
+from app.infrastructure.database.repository import RateLimitRepository
+
+
+class FakeRateLimitCollection:
+    """
+    Motor collection giả: chạy find_one_and_update (upsert, ReturnDocument.AFTER) trong bộ nhớ,
+    chỉ hỗ trợ các toán tử mà pipeline của record_request dùng.
+    """
+    def __init__(self):
+        self.documents = {}
+
+    def _eval(self, expr, doc, variables):
+        if isinstance(expr, str):
+            if expr.startswith("$$"):
+                return variables[expr[2:]]
+            if expr.startswith("$"):
+                return doc.get(expr[1:])
+            return expr
+        if isinstance(expr, list):
+            return [self._eval(item, doc, variables) for item in expr]
+        if not isinstance(expr, dict):
+            return expr
+        (op, args), = expr.items()
+        if op == "$filter":
+            items = self._eval(args["input"], doc, variables)
+            return [item for item in items
+                    if self._eval(args["cond"], doc, {**variables, args["as"]: item})]
+        values = self._eval(args, doc, variables)
+        if op == "$ifNull":
+            return values[0] if values[0] is not None else values[1]
+        if op == "$gt":
+            return values[0] > values[1]
+        if op == "$lt":
+            return values[0] < values[1]
+        if op == "$size":
+            return len(values)
+        if op == "$cond":
+            return values[1] if values[0] else values[2]
+        if op == "$concatArrays":
+            return [item for array in values for item in array]
+        raise NotImplementedError(op)
+
+    async def find_one_and_update(self, filter, pipeline, upsert=False, return_document=None):
+        key = filter["key"]
+        doc = dict(self.documents.get(key, {"key": key}))
+        for stage in pipeline:
+            (op, fields), = stage.items()
+            assert op == "$set"
+            # Các field trong cùng một $set đều đọc document trước stage đó
+            doc.update({name: self._eval(expr, doc, {}) for name, expr in fields.items()})
+        self.documents[key] = doc
+        return doc
+
+
+@pytest.mark.asyncio
+async def test_record_request_allows_until_limit():
+    repo = RateLimitRepository(FakeRateLimitCollection())
+    results = [await repo.record_request("guest_1", now, window_start=0, max_requests=3) for now in (1.0, 2.0, 3.0, 4.0)]
+
+    assert [doc["last_allowed"] for doc in results] == [True, True, True, False]
+    # Request bị từ chối không được ghi thêm timestamp
+    assert results[-1]["timestamps"] == [1.0, 2.0, 3.0]
+
+
+@pytest.mark.asyncio
+async def test_record_request_drops_timestamps_outside_window():
+    repo = RateLimitRepository(FakeRateLimitCollection())
+    for now in (1.0, 2.0):
+        await repo.record_request("guest_1", now, window_start=0, max_requests=2)
+
+    doc = await repo.record_request("guest_1", 20.0, window_start=1.5, max_requests=2)
+    assert doc["last_allowed"] is True
+    assert doc["timestamps"] == [2.0, 20.0]
+
+
+@pytest.mark.asyncio
+async def test_record_request_keys_are_independent():
+    repo = RateLimitRepository(FakeRateLimitCollection())
+    await repo.record_request("guest_1", 1.0, window_start=0, max_requests=1)
+    doc = await repo.record_request("guest_2", 1.0, window_start=0, max_requests=1)
+    assert doc["last_allowed"] is True
+
+
+class FakeRepository:
+    def __init__(self, doc):
+        self.doc = doc
+
+    async def record_request(self, key, now, window_start, max_requests):
+        return self.doc
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("doc, limited", [
+    ({"timestamps": [1.0], "last_allowed": True}, False),
+    ({"timestamps": [1.0], "last_allowed": False}, True),
+    ({}, True),
+])
+async def test_check_rate_limit_reads_last_allowed(doc, limited):
+    limiter = MongoRateLimiter()
+    limiter._repository = FakeRepository(doc)
+    assert await limiter.check_rate_limit("guest_1", max_requests=1, window_seconds=60) is limited
@@ -0,0 +1,112 @@
+import sys
+import os
+import base64
+import json
+import math
+import time
+from types import SimpleNamespace
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("SECRET_KEY", "unit-test-secret-key-0123456789abcdef")
+
+import pytest
+
+pytest.importorskip("firebase_admin")
+
+from app.auth import router as auth_router
+from app.auth.router import _resolve_token_user, create_access_token, user_token_claims
+
+
+def make_firebase_user(uid="firebase-uid"):
+    return SimpleNamespace(
+        uid=uid,
+        email="tester@email.com",
+        display_name="Tester",
+        photo_url=None,
+        email_verified=True,
+        provider_data=[SimpleNamespace(provider_id="password")],
+        user_metadata=SimpleNamespace(creation_timestamp=1_700_000_000_000),
+    )
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def make_firebase_id_token(uid="firebase-uid"):
+    # Chỉ cần header RS256 + kid để đi vào nhánh Firebase; chữ ký do verify_firebase_token (mock) kiểm tra
+    header = b64url(json.dumps({"alg": "RS256", "kid": "key-1", "typ": "JWT"}).encode())
+    payload = b64url(json.dumps({"sub": uid}).encode())
+    return f"{header}.{payload}.{b64url(b'signature')}"
+
+
+@pytest.fixture
+def firebase_calls(monkeypatch):
+    """Thay các lời gọi Firebase Admin bằng mock và ghi lại tham số."""
+    calls = {"verify": [], "get_user": []}
+
+    async def fake_verify(token):
+        calls["verify"].append(token)
+        return {"uid": "firebase-uid", "exp": 1234}
+
+    async def fake_get_user(uid):
+        calls["get_user"].append(uid)
+        return make_firebase_user(uid)
+
+    monkeypatch.setattr(auth_router, "verify_firebase_token", fake_verify)
+    monkeypatch.setattr(auth_router, "get_user_from_firebase", fake_get_user)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_own_token_with_profile_claims_needs_no_firebase(firebase_calls):
+    token = create_access_token(user_token_claims(make_firebase_user("user-1")))
+    user, expires_at = await _resolve_token_user(token)
+
+    assert user.user_id == "user-1"
+    assert user.email == "tester@email.com"
+    assert user.providers == ["password"]
+    assert time.time() < expires_at < math.inf
+    assert firebase_calls == {"verify": [], "get_user": []}
+
+
+@pytest.mark.asyncio
+async def test_own_token_without_profile_claims_looks_up_user(firebase_calls):
+    token = create_access_token({"sub": "user-1"})
+    user, _ = await _resolve_token_user(token)
+
+    assert user.user_id == "user-1"
+    assert firebase_calls == {"verify": [], "get_user": ["user-1"]}
+
+
+@pytest.mark.asyncio
+async def test_token_with_kid_goes_to_firebase(firebase_calls):
+    token = make_firebase_id_token()
+    user, expires_at = await _resolve_token_user(token)
+
+    assert user.user_id == "firebase-uid"
+    assert expires_at == 1234
+    assert firebase_calls == {"verify": [token], "get_user": ["firebase-uid"]}
+
+
+@pytest.mark.asyncio
+async def test_own_token_with_bad_signature_is_rejected(firebase_calls, monkeypatch):
+    token = create_access_token({"sub": "user-1", "email": "tester@email.com"})
+    monkeypatch.setattr(auth_router, "JWT_KEY", b"another-secret-key-0123456789abcdef")
+
+    assert await _resolve_token_user(token) == (None, math.inf)
+    assert firebase_calls == {"verify": [], "get_user": []}
+
+
+@pytest.mark.asyncio
+async def test_garbage_token_is_rejected_without_firebase(firebase_calls):
+    assert await _resolve_token_user("not-a-jwt") == (None, math.inf)
+    assert firebase_calls == {"verify": [], "get_user": []}
+
+
+@pytest.mark.asyncio
+async def test_invalid_firebase_token_resolves_to_none(monkeypatch):
+    async def fake_verify(token):
+        raise ValueError("malformed")
+    monkeypatch.setattr(auth_router, "verify_firebase_token", fake_verify)
+
+    assert await _resolve_token_user(make_firebase_id_token()) == (None, math.inf)